@@ -1,25 +1,58 @@
 import os
-import asyncio, functools, time
+import json, hashlib
+import asyncio, functools, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
 from query_constructions import load_image_content
+from pipeline_utils import run_in_process, join_queues, drain_queue, log_timestamp, log_writer, make_bug_dirs
+from text_preprocessing import processBugReportContent
+import text_preprocessing, tools
 from agents import (
     readBugReportContent_agent,
-    processBugReportContent_agent,
-    processBugReportQueryKeyBERT_agent,
+    processBugReportQueryKeyBERT_batch_agent,
     index_source_code_agent,
-    bug_localization_BM25_and_FAISS_agent
+    bug_localization_BM25_and_FAISS_batch_agent
 )
 
-# Queues between pipeline stages, initialized in main_async
-read_queue = process_queue = keybert_queue = localization_queue = None
 
-
-# Shared index data
-bm25_index = None
-faiss_index = None
+# Default settings, copied into each project's PipelineCtx
 bm25_weight = 0.5
 faiss_weight = 0.5
 top_n = 10 # Number of top keywords to retrieve
 top_n_documents = 100 # Number of top documents to retrieve, but default is 100
+read_workers = 8 # Number of bug folders read concurrently
+project_workers = 2 # Number of projects processed at once, each loads its own models and indexes
+# Number of bug reports preprocessed in parallel per project, the projects share the cores
+process_workers = max(1, min(4, (os.cpu_count() or 1) // project_workers))
+keybert_batch_size = 16 # Max number of bugs whose contents are encoded together
+keybert_batch_linger = 0.05 # Seconds a KeyBERT batch waits for more bugs before it is encoded
+localize_batch_size = 32 # Max number of bugs whose queries are searched together
+rebuild_indexes = False # Build the BM25 and FAISS indexes again even when the stored ones match the source code
+query_cache_root = "./.cache/keybert" # Processed contents and KeyBERT queries by bug content hash, one folder per project
+
+
+@dataclass
+class PipelineCtx:
+    '''State of one project's pipeline run, created in main_async and passed to every worker'''
+    project_id: str
+    output_base: str
+    search_base: str
+    cache_dir: str
+    cache_version: str
+    bm25_index: object
+    faiss_index: object
+    processed_documents: list
+    process_pool: ProcessPoolExecutor
+    top_n: int = top_n
+    top_n_documents: int = top_n_documents
+    bm25_weight: float = bm25_weight
+    faiss_weight: float = faiss_weight
+    # bounded queues so a fast stage waits for a slow one instead of buffering every bug in memory
+    read_queue: asyncio.Queue = field(default_factory=lambda: asyncio.Queue(maxsize=2 * read_workers))
+    process_queue: asyncio.Queue = field(default_factory=lambda: asyncio.Queue(maxsize=2 * process_workers))
+    keybert_queue: asyncio.Queue = field(default_factory=lambda: asyncio.Queue(maxsize=2 * keybert_batch_size))
+    localization_queue: asyncio.Queue = field(default_factory=lambda: asyncio.Queue(maxsize=2 * localize_batch_size))
+    log_queue: asyncio.Queue = field(default_factory=asyncio.Queue)
 
 
 
@@ -29,136 +62,251 @@ async def run_blocking(fn, *args, **kw):
     part = functools.partial(fn, *args, **kw)
     return await loop.run_in_executor(None, part)
 
-#Helper: Log events to the pipeline_log.txt file
-log_lock = asyncio.Lock()
-async def log_event(tag, bug_id, stage, project_id):
-    ts = time.strftime("%H:%M:%S", time.localtime())
-    line = f"[{ts}] [{tag}] Project {project_id} Bug {bug_id} at stage: {stage}\n"
-    async with log_lock:
-        with open("./logs/parallel_logs/keybert_log.txt", "a", encoding="utf-8") as f:
-            f.write(line)
+def query_cache_version():
+    '''Hash of what the cached queries depend on besides the bug contents: the KeyBERT model and backend,
+    the stopwords and the code of the preprocessing and of the KeyBERT extraction (with its parameters)'''
+    version = hashlib.blake2b(tools.keybert_model_tag().encode("utf-8"), digest_size=16)
+    for path in (text_preprocessing.STOPWORDS_PATH, text_preprocessing.__file__, tools.__file__):
+        try:
+            with open(path, "rb") as f:
+                version.update(f.read())
+        except OSError:  # no stopwords file: a later run with the file gets new keys
+            version.update(b"missing " + path.encode("utf-8"))
+    return version.hexdigest()
+
+# Helper: cache key of a bug, any change to its raw contents, to top_n or to the cache version gives a new key
+def query_cache_key(raw, extended_raw, top_n, cache_version):
+    return hashlib.blake2b(f"{cache_version}\0{top_n}\0{raw}\0{extended_raw}".encode("utf-8"), digest_size=16).hexdigest()
+
+def load_cached_queries(cache_dir, key):
+    '''Returns the cached processed contents and queries of a bug, None on a miss'''
+    try:
+        with open(os.path.join(cache_dir, key + ".json"), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
 
-async def read_worker(project_id):
+def save_cached_queries(cache_dir, entries):
+    '''Writes each (key, cache entry) pair to the query cache'''
+    os.makedirs(cache_dir, exist_ok=True)
+    for key, entry in entries:
+        with open(os.path.join(cache_dir, key + ".json"), "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+
+#Helper: Log events to the project's keybert log, queued for the log_writer task
+async def log_event(ctx, tag, bug_id, stage):
+    ts = log_timestamp()
+    line = f"[{ts}] [{tag}] Project {ctx.project_id} Bug {bug_id} at stage: {stage}\n"
+    ctx.log_queue.put_nowait(line)
+
+async def read_worker(ctx):
     '''Reads title + description from bug report folder'''
     while True:
-        bug_dir, bug_id = await read_queue.get()
-        await log_event("READ", bug_id, "start", project_id)
-        raw = readBugReportContent_agent.run(bug_dir).get("file_content", "")
-        extended_raw = raw + "\n" + load_image_content(bug_dir, bug_id)
-        await log_event("READ", bug_id, "done", project_id)
-        await process_queue.put((bug_dir, bug_id, raw, extended_raw))
-        read_queue.task_done()
-
-async def process_worker(project_id):
+        bug_dir, bug_id = await ctx.read_queue.get()
+        await log_event(ctx, "READ", bug_id, "start")
+        raw = await run_blocking(readBugReportContent_agent.run_raw, bug_dir)
+        image_text = await run_blocking(load_image_content, bug_dir, bug_id)
+        # one join instead of two concatenations, and no copy at all when the bug has no image content
+        extended_raw = "\n".join((raw, image_text)) if image_text else raw
+        await log_event(ctx, "READ", bug_id, "done")
+        cache_key = query_cache_key(raw, extended_raw, ctx.top_n, ctx.cache_version)
+        cached = await run_blocking(load_cached_queries, ctx.cache_dir, cache_key)
+        if cached is None:
+            await ctx.process_queue.put((bug_dir, bug_id, cache_key, raw, extended_raw))
+        else:
+            # same contents as a previous run: skip preprocessing and KeyBERT, only the query files are rewritten
+            await log_event(ctx, "KEYBERT", bug_id, "cached")
+            queries = (cached["baseline_query"], cached["extended_query"])
+            await run_blocking(write_keybert_queries, ctx.output_base, [bug_id], [queries])
+            await ctx.localization_queue.put((bug_id, *queries))
+        ctx.read_queue.task_done()
+
+async def process_worker(ctx):
     '''Processes baseline and extended content'''
     while True:
-        bug_dir, bug_id, raw, extended_raw= await process_queue.get()
-        await log_event("PROCESS", bug_id, "start", project_id)
-        processed = processBugReportContent_agent.run(raw).get("file_content", "")
-        extended_processed = processBugReportContent_agent.run(extended_raw).get("file_content", "")
-        await log_event("PROCESS", bug_id, "done", project_id)
-        await keybert_queue.put((bug_dir, bug_id, processed, extended_processed))
-        process_queue.task_done()
-
-async def keybert_worker(output_base, top_n, project_id):
-    '''Extracts keywords for both baseline and extended queries and writes them to disk'''
-    while True:
-        bug_dir, bug_id, baseline_processed, extended_processed= await keybert_queue.get()
-        await log_event("KEYBERT", bug_id, "start", project_id)
-
-        # === Baseline ===
-        keywords = await run_blocking(processBugReportQueryKeyBERT_agent.run, baseline_processed, top_n)
-        baseline_query = " ".join(keywords.get("file_content", [])) 
-
-        # === Extended ===
-        extended_keywords = await run_blocking(processBugReportQueryKeyBERT_agent.run, extended_processed, top_n)
-        extended_query = " ".join(extended_keywords.get("file_content", [])) 
+        bug_dir, bug_id, cache_key, raw, extended_raw= await ctx.process_queue.get()
+        await log_event(ctx, "PROCESS", bug_id, "start")
+        # extended_raw is raw, or raw + "\n" + image content and preprocessing never joins tokens across that newline,
+        # so only the image content is preprocessed on top of raw
+        processed, image_processed = await asyncio.gather(
+            run_in_process(ctx.process_pool, processBugReportContent, raw),
+            run_in_process(ctx.process_pool, processBugReportContent, extended_raw[len(raw):]),
+        )
+        extended_processed = " ".join(filter(None, [processed, image_processed]))
+        await log_event(ctx, "PROCESS", bug_id, "done")
+        await ctx.keybert_queue.put((bug_dir, bug_id, cache_key, processed, extended_processed))
+        ctx.process_queue.task_done()
 
+def write_keybert_queries(output_base, bug_ids, queries):
+    '''Writes the baseline and extended KeyBERT query of each bug to its output folder'''
+    for bug_id, (baseline_query, extended_query) in zip(bug_ids, queries):
         output_dir = os.path.join(output_base, bug_id)
-        os.makedirs(output_dir, exist_ok=True)
         with open(os.path.join(output_dir, f"{bug_id}_baseline_keyBERT_query.txt"), "w", encoding="utf-8") as f:
             f.write(baseline_query)
         with open(os.path.join(output_dir, f"{bug_id}_extended_keyBERT_query.txt"), "w", encoding="utf-8") as f:
             f.write(extended_query)
 
-        await log_event("KEYBERT", bug_id, "done", project_id)
-        await localization_queue.put((bug_id, baseline_query, extended_query))
-        keybert_queue.task_done()
+async def keybert_worker(ctx):
+    '''Extracts keywords for the baseline and extended queries of a batch of bugs and writes them to disk'''
+    while True:
+        batch = await drain_queue(ctx.keybert_queue, keybert_batch_size, keybert_batch_linger)
+
+        contents = []
+        for bug_dir, bug_id, cache_key, baseline_processed, extended_processed in batch:
+            await log_event(ctx, "KEYBERT", bug_id, "start")
+            contents += [baseline_processed, extended_processed]
+
+        # === Baseline and extended of every bug in one KeyBERT call ===
+        keywords = await run_blocking(processBugReportQueryKeyBERT_batch_agent.run_raw, contents, ctx.top_n)
+        failed = isinstance(keywords, str)
+        if failed:
+            # the agent failed, use its error message as the query (not cached, the next run retries it)
+            keywords = [[keywords]] * len(contents)
+
+        bug_ids = [bug_id for _, bug_id, _, _, _ in batch]
+        queries = [(" ".join(keywords[2 * i]), " ".join(keywords[2 * i + 1])) for i in range(len(batch))]
+        # all query files of the batch are written in one executor call instead of on the event loop
+        await run_blocking(write_keybert_queries, ctx.output_base, bug_ids, queries)
+        if not failed:
+            cache_entries = [(cache_key, {"processed": processed, "extended_processed": extended_processed,
+                                          "baseline_query": baseline_query, "extended_query": extended_query})
+                             for (_, _, cache_key, processed, extended_processed), (baseline_query, extended_query) in zip(batch, queries)]
+            await run_blocking(save_cached_queries, ctx.cache_dir, cache_entries)
+
+        for bug_id, (baseline_query, extended_query) in zip(bug_ids, queries):
+            await log_event(ctx, "KEYBERT", bug_id, "done")
+            await ctx.localization_queue.put((bug_id, baseline_query, extended_query))
+            ctx.keybert_queue.task_done()
+
+def write_search_results(result_files):
+    '''Writes each (path, search results) pair, the bug's result folder already exists'''
+    for path, search_results in result_files:
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(search_results)
 
-async def localize_worker(search_base, top_n_documents, processed_documents, project_id):
-    '''Runs BM25+FAISS localization on extended queries'''
+async def localize_worker(ctx):
+    '''Runs BM25+FAISS localization on the baseline and extended queries of a batch of bugs'''
     while True:
-        bug_id, baseline_q, extended_q = await localization_queue.get()
-
-        await log_event("LOCALIZE", bug_id, "baseline start", project_id)
-        baseline_search_results = await run_blocking(
-            bug_localization_BM25_and_FAISS_agent.run,
-            bug_id, baseline_q, top_n_documents,
-            bm25_index, faiss_index, processed_documents,
-            bm25_weight, faiss_weight
-        )
+        batch = await drain_queue(ctx.localization_queue, localize_batch_size)
+
+        bug_ids, queries = [], []
+        for bug_id, baseline_q, extended_q in batch:
+            await log_event(ctx, "LOCALIZE", bug_id, "start")
+            bug_ids += [bug_id, bug_id]
+            queries += [baseline_q, extended_q]
+
+        # identical queries are searched once, e.g. extended == baseline when a bug has no image content
+        unique_queries = {}
+        for bug_id, query in zip(bug_ids, queries):
+            unique_queries.setdefault(query, bug_id)
 
-        out_dir = os.path.join(search_base, bug_id)
-        os.makedirs(out_dir, exist_ok=True)
-        with open(os.path.join(out_dir, f"{bug_id}_baseline_keyBERT_query_result.txt"),
-                  "w", encoding="utf-8") as f:
-            f.write(baseline_search_results.get("file_content", ""))
-        await log_event("LOCALIZE", bug_id, "baseline done", project_id)
-
-        await log_event("LOCALIZE", bug_id, "extended start", project_id)
-        extended_search_results = await run_blocking(
-            bug_localization_BM25_and_FAISS_agent.run,
-            bug_id, extended_q, top_n_documents,
-            bm25_index, faiss_index, processed_documents,
-            bm25_weight, faiss_weight
+        search_results = await run_blocking(
+            bug_localization_BM25_and_FAISS_batch_agent.run_raw,
+            list(unique_queries.values()), list(unique_queries), ctx.top_n_documents,
+            ctx.bm25_index, ctx.faiss_index, ctx.processed_documents,
+            ctx.bm25_weight, ctx.faiss_weight
         )
-        with open(os.path.join(out_dir, f"{bug_id}_extended_keyBERT_query_result.txt"),
-                  "w", encoding="utf-8") as f:
-            f.write(extended_search_results.get("file_content", ""))
-        await log_event("LOCALIZE", bug_id, "extended done", project_id)
-        localization_queue.task_done()
+        if isinstance(search_results, str):
+            # the agent failed, write its error message for every query
+            search_results = [search_results] * len(unique_queries)
+        results_by_query = dict(zip(unique_queries, search_results))
+        search_results = [results_by_query[query] for query in queries]
+
+        result_files = []
+        for i, (bug_id, _, _) in enumerate(batch):
+            out_dir = os.path.join(ctx.search_base, bug_id)
+            result_files += [(os.path.join(out_dir, f"{bug_id}_baseline_keyBERT_query_result.txt"), search_results[2 * i]),
+                             (os.path.join(out_dir, f"{bug_id}_extended_keyBERT_query_result.txt"), search_results[2 * i + 1])]
+        # the writes run in the executor, so the other stages keep running meanwhile
+        await run_blocking(write_search_results, result_files)
+
+        for bug_id, _, _ in batch:
+            await log_event(ctx, "LOCALIZE", bug_id, "done")
+            ctx.localization_queue.task_done()
 
 async def main_async(project_id, bug_reports_root, queries_output_root, search_result_path, source_code_dir, bm25_faiss_dir):
-    global read_queue, process_queue, keybert_queue, localization_queue
-    global bm25_index, faiss_index
-    read_queue         = asyncio.Queue()
-    process_queue      = asyncio.Queue()
-    keybert_queue      = asyncio.Queue()
-    localization_queue = asyncio.Queue()
-    
     # index source code and load indexes (bm25_index, faiss_index) and processed documents
-    bm25_index, faiss_index, processed_documents = index_source_code_agent.run(source_code_dir, f"project{project_id}", bm25_faiss_dir).get("file_content", "")
-    top_n_documents = len(processed_documents) # Number of top documents to retrieve, but default is 100
+    bm25_index, faiss_index, processed_documents = index_source_code_agent.run(source_code_dir, f"project{project_id}", bm25_faiss_dir, rebuild_indexes).get("file_content", "")
+
+    ctx = PipelineCtx(
+        project_id=project_id,
+        output_base=os.path.join(queries_output_root, project_id),
+        search_base=os.path.join(search_result_path, project_id),
+        cache_dir=os.path.join(query_cache_root, project_id),
+        cache_version=query_cache_version(),
+        bm25_index=bm25_index,
+        faiss_index=faiss_index,
+        processed_documents=processed_documents,
+        process_pool=ProcessPoolExecutor(max_workers=process_workers, mp_context=multiprocessing.get_context("spawn")),
+        top_n_documents=len(processed_documents), # rank every document, not just the default 100
+    )
 
     bug_path = os.path.join(bug_reports_root, project_id)
-    output_base = os.path.join(queries_output_root, project_id)
-    os.makedirs(output_base, exist_ok=True)
-    search_results_base = os.path.join(search_result_path, project_id)
-    os.makedirs(search_results_base, exist_ok=True)
+    os.makedirs(ctx.output_base, exist_ok=True)
+    os.makedirs(ctx.search_base, exist_ok=True)
+    # one log per project: the projects run in separate processes, each with its own log writer
     os.makedirs("./logs/parallel_logs", exist_ok=True)
-
-    # Fill read queue with bug IDs
-    for bug_id in os.listdir(bug_path):
-        bug_dir = os.path.join(bug_path, bug_id)
-        if os.path.isdir(bug_dir):
-            await read_queue.put((bug_dir, bug_id))
+    log_path = f"./logs/parallel_logs/keybert_log_{project_id}.txt"
+    open(log_path, "w").close()
 
     # Start
     workers = [
-        asyncio.create_task(read_worker(project_id)),
-        asyncio.create_task(process_worker(project_id)),
-        asyncio.create_task(keybert_worker(output_base, top_n, project_id)),
-        *[asyncio.create_task(localize_worker(search_results_base, top_n_documents, processed_documents, project_id)) for _ in range(4)],
+        *[asyncio.create_task(read_worker(ctx)) for _ in range(read_workers)],
+        *[asyncio.create_task(process_worker(ctx)) for _ in range(process_workers)],
+        asyncio.create_task(keybert_worker(ctx)),
+        # one localize worker: FAISS and the BM25 kernel already use every core for a batch,
+        # concurrent batches would only oversubscribe the threads
+        asyncio.create_task(localize_worker(ctx)),
+        asyncio.create_task(log_writer(ctx.log_queue, log_path)),
     ]
+    # Fill read queue with bug IDs, the workers are already running since the queue is bounded
+    # scandir entries carry their type, no extra stat per bug folder
+    with os.scandir(bug_path) as entries:
+        bug_dirs = [(entry.path, entry.name) for entry in entries if entry.is_dir()]
+    # every bug's query and result folders are created up front in one executor call, not per write
+    await run_blocking(make_bug_dirs, [ctx.output_base, ctx.search_base], [bug_id for _, bug_id in bug_dirs])
+    for bug_dir, bug_id in bug_dirs:
+        await ctx.read_queue.put((bug_dir, bug_id))
+
     # Wait for all queues to finish
-    await read_queue.join()
-    await process_queue.join()
-    await keybert_queue.join()
-    await localization_queue.join()
+    await join_queues([ctx.read_queue, ctx.process_queue, ctx.keybert_queue, ctx.localization_queue, ctx.log_queue], workers)
 
     # Finish
     for w in workers:
         w.cancel()
+    ctx.process_pool.shutdown()
+
+
+def run_project(project_id, bug_reports_root, queries_output_root, search_result_path, source_codes_root, bm25_faiss_dir):
+    '''Runs the whole pipeline for one project, in its own process so several projects can run at once'''
+    print(f"\n=== Processing Project {project_id} with KeyBERT ===")
+    
+    # Find the source code directory for this project
+    project_source_dir = os.path.join(source_codes_root, f"Project{project_id}")
+    
+    # Find the actual source directory (exclude Corpus directory)
+    if os.path.exists(project_source_dir):
+        with os.scandir(project_source_dir) as entries:
+            subdirs = [entry.name for entry in entries if entry.is_dir() and entry.name != "Corpus"]
+        if subdirs:
+            # Take the first non-Corpus subdirectory as the source directory
+            source_code_dir = os.path.join(project_source_dir, subdirs[0])
+            # If there's a 'src' directory inside, use that
+            src_dir = os.path.join(source_code_dir, "src")
+            if os.path.exists(src_dir):
+                source_code_dir = src_dir
+        else:
+            source_code_dir = project_source_dir
+    else:
+        print(f"Warning: Source code directory not found for Project {project_id}")
+        return
+    
+    print(f"Using source code directory: {source_code_dir}")
+    
+    asyncio.run(main_async(project_id, bug_reports_root, queries_output_root, 
+                           search_result_path, source_code_dir, bm25_faiss_dir))
+    
+    print(f"=== Completed Project {project_id} ===")
 
 
 if __name__ == "__main__":
@@ -175,39 +323,16 @@ if __name__ == "__main__":
     #projects = ["14", "20", "24"]
     
     
-    # Clear the log file at the start
-    os.makedirs("./logs/parallel_logs", exist_ok=True)
-    open("./logs/parallel_logs/keybert_log.txt", "w").close()
     
+    # Each project runs in its own process: the pipeline state is per process, and a small
+    # pool keeps the models and indexes of only project_workers projects in memory at once
     async def process_all_projects():
-        for project_id in projects:
-            print(f"\n=== Processing Project {project_id} with KeyBERT ===")
-            
-            # Find the source code directory for this project
-            project_source_dir = os.path.join(source_codes_root, f"Project{project_id}")
-            
-            # Find the actual source directory (exclude Corpus directory)
-            if os.path.exists(project_source_dir):
-                subdirs = [d for d in os.listdir(project_source_dir) 
-                          if os.path.isdir(os.path.join(project_source_dir, d)) and d != "Corpus"]
-                if subdirs:
-                    # Take the first non-Corpus subdirectory as the source directory
-                    source_code_dir = os.path.join(project_source_dir, subdirs[0])
-                    # If there's a 'src' directory inside, use that
-                    src_dir = os.path.join(source_code_dir, "src")
-                    if os.path.exists(src_dir):
-                        source_code_dir = src_dir
-                else:
-                    source_code_dir = project_source_dir
-            else:
-                print(f"Warning: Source code directory not found for Project {project_id}")
-                continue
-            
-            print(f"Using source code directory: {source_code_dir}")
-            
-            await main_async(project_id, bug_reports_root, queries_output_root, 
-                           search_result_path, source_code_dir, bm25_faiss_dir)
-            
-            print(f"=== Completed Project {project_id} ===")
+        loop = asyncio.get_running_loop()
+        with ProcessPoolExecutor(max_workers=project_workers, mp_context=multiprocessing.get_context("spawn")) as project_pool:
+            await asyncio.gather(*[
+                loop.run_in_executor(project_pool, run_project, project_id, bug_reports_root, queries_output_root,
+                                     search_result_path, source_codes_root, bm25_faiss_dir)
+                for project_id in projects
+            ])
     
-    asyncio.run(process_all_projects())
\ No newline at end of file
+    asyncio.run(process_all_projects())
@@ -1,22 +1,45 @@
 import os
-import asyncio, functools, time
+import asyncio, functools, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
 from query_constructions import load_image_content
+from pipeline_utils import run_in_process, join_queues, drain_queue, log_timestamp, log_writer
+from text_preprocessing import processBugReportContent_batch
 from agents import (
     readBugReportContent_agent,
-    processBugReportContent_agent,
     index_source_code_agent,
     bug_localization_BM25_and_FAISS_agent,
 )
 
-# Queues between pipeline stages
-read_queue = process_queue = localization_queue = None
-
-# Shared index data
-bm25_index = None
-faiss_index = None
+# Default settings, copied into each project's PipelineCtx
 bm25_weight = 0.5
 faiss_weight = 0.5
 top_n_documents = 100
+read_workers = 8 # Number of bug folders read concurrently
+project_workers = 2 # Number of projects processed at once
+# Number of bug report batches preprocessed in parallel per project, the projects share the cores
+process_workers = max(1, min(4, (os.cpu_count() or 1) // project_workers))
+process_batch_size = 16 # Max number of bug reports preprocessed by one process pool task
+
+
+@dataclass
+class PipelineCtx:
+    '''State of one project's pipeline run, created in main_async and passed to every worker'''
+    project_id: str
+    constructed_base: str
+    search_base: str
+    process_pool: ProcessPoolExecutor
+    bm25_index: object = None
+    faiss_index: object = None
+    processed_documents: list = field(default_factory=list)
+    top_n_documents: int = top_n_documents
+    bm25_weight: float = bm25_weight
+    faiss_weight: float = faiss_weight
+    # bounded queues so a fast stage waits for a slow one instead of buffering every bug in memory
+    read_queue: asyncio.Queue = field(default_factory=lambda: asyncio.Queue(maxsize=2 * read_workers))
+    process_queue: asyncio.Queue = field(default_factory=lambda: asyncio.Queue(maxsize=2 * process_batch_size))
+    localization_queue: asyncio.Queue = field(default_factory=lambda: asyncio.Queue(maxsize=32))
+    log_queue: asyncio.Queue = field(default_factory=asyncio.Queue)
 
 # Helper: run blocking code in thread
 async def run_blocking(fn, *args, **kw):
@@ -24,109 +47,153 @@ async def run_blocking(fn, *args, **kw):
     part = functools.partial(fn, *args, **kw)
     return await loop.run_in_executor(None, part)
 
-# Helper: log events to file
-log_lock = asyncio.Lock()
-async def log_event(tag, bug_id, stage, project_id):
-    ts = time.strftime("%H:%M:%S", time.localtime())
-    line = f"[{ts}] [{tag}] Project {project_id} Bug {bug_id} at stage: {stage}\n"
-    async with log_lock:
-        with open("./logs/parallel_logs/NLP_log.txt", "a", encoding="utf-8") as f:
-            f.write(line)
+# Helper : write a text file, called through run_blocking so the event loop keeps running
+def write_text(path, content):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(content)
+
+# Helper: log events to file, queued for the log_writer task
+async def log_event(ctx, tag, bug_id, stage):
+    ts = log_timestamp()
+    line = f"[{ts}] [{tag}] Project {ctx.project_id} Bug {bug_id} at stage: {stage}\n"
+    ctx.log_queue.put_nowait(line)
 
-async def read_worker(project_id):
+async def read_worker(ctx):
     while True:
-        bug_dir, bug_id = await read_queue.get()
-        await log_event("READ", bug_id, "start", project_id)
-        raw = readBugReportContent_agent.run(bug_dir).get("file_content", "")
-        extended_raw = raw + "\n" + load_image_content(bug_dir, bug_id)
-        await log_event("READ", bug_id, "done", project_id)
-        await process_queue.put((bug_id, raw, extended_raw))
-        read_queue.task_done()
-
-async def process_worker(output_base, project_id):
+        bug_dir, bug_id = await ctx.read_queue.get()
+        await log_event(ctx, "READ", bug_id, "start")
+        raw = await run_blocking(readBugReportContent_agent.run_raw, bug_dir)
+        image_text = await run_blocking(load_image_content, bug_dir, bug_id)
+        # one join instead of two concatenations, and no copy at all when the bug has no image content
+        extended_raw = "\n".join((raw, image_text)) if image_text else raw
+        await log_event(ctx, "READ", bug_id, "done")
+        await ctx.process_queue.put((bug_id, raw, extended_raw))
+        ctx.read_queue.task_done()
+
+async def process_worker(ctx):
     while True:
-        bug_id, raw, extended_raw = await process_queue.get()
-        await log_event("PROCESS", bug_id, "start", project_id)
+        # whatever bugs are queued are preprocessed in one process pool task instead of one task each
+        batch = await drain_queue(ctx.process_queue, process_batch_size)
+        for bug_id, _, _ in batch:
+            await log_event(ctx, "PROCESS", bug_id, "start")
 
         #baseline = processBugReportContent_agent.run(raw).get("file_content", "")
-        extended = processBugReportContent_agent.run(extended_raw).get("file_content", "")
-
-        # out_dir = os.path.join(output_base, project_id)
-        # os.makedirs(out_dir, exist_ok=True)
-        # # with open(os.path.join(out_dir, f"{bug_id}_baseline_basic_query.txt"), "w", encoding="utf-8") as f:
-        #     f.write(baseline)
-        with open(os.path.join(output_base, f"{bug_id}_baseline_reasoning_query.txt"), "w", encoding="utf-8") as f:
-            f.write(extended)
-
-        await log_event("PROCESS", bug_id, "done", project_id)
-        #await localization_queue.put((bug_id, baseline, extended))
-        process_queue.task_done()
-
-async def localize_worker(search_base, top_n_documents, processed_documents, project_id):
+        extended_raws = [extended_raw for _, _, extended_raw in batch]
+        extended = await run_in_process(ctx.process_pool, processBugReportContent_batch, extended_raws)
+        if isinstance(extended, str):
+            # preprocessing failed, write its error message for every bug
+            extended = [extended] * len(batch)
+
+        for (bug_id, _, _), bug_extended in zip(batch, extended):
+            # out_dir = os.path.join(output_base, project_id)
+            # os.makedirs(out_dir, exist_ok=True)
+            # # with open(os.path.join(out_dir, f"{bug_id}_baseline_basic_query.txt"), "w", encoding="utf-8") as f:
+            #     f.write(baseline)
+            await run_blocking(write_text, os.path.join(ctx.constructed_base, f"{bug_id}_baseline_reasoning_query.txt"), bug_extended)
+
+            await log_event(ctx, "PROCESS", bug_id, "done")
+            #await ctx.localization_queue.put((bug_id, baseline, extended))
+            ctx.process_queue.task_done()
+
+async def localize_worker(ctx):
     while True:
-        bug_id, baseline_q, extended_q = await localization_queue.get()
-        out_dir = os.path.join(search_base, bug_id)
+        bug_id, baseline_q, extended_q = await ctx.localization_queue.get()
+        out_dir = os.path.join(ctx.search_base, bug_id)
         os.makedirs(out_dir, exist_ok=True)
 
-        await log_event("LOCALIZE", bug_id, "baseline start", project_id)
+        await log_event(ctx, "LOCALIZE", bug_id, "baseline start")
         baseline_res = await run_blocking(
             bug_localization_BM25_and_FAISS_agent.run,
-            bug_id, baseline_q, top_n_documents,
-            bm25_index, faiss_index, processed_documents,
-            bm25_weight, faiss_weight
+            bug_id, baseline_q, ctx.top_n_documents,
+            ctx.bm25_index, ctx.faiss_index, ctx.processed_documents,
+            ctx.bm25_weight, ctx.faiss_weight
         )
         with open(os.path.join(out_dir, f"{bug_id}_baseline_basic_query_result.txt"), "w", encoding="utf-8") as f:
             f.write(baseline_res.get("file_content", ""))
-        await log_event("LOCALIZE", bug_id, "baseline done", project_id)
+        await log_event(ctx, "LOCALIZE", bug_id, "baseline done")
 
-        await log_event("LOCALIZE", bug_id, "extended start", project_id)
+        await log_event(ctx, "LOCALIZE", bug_id, "extended start")
         extended_res = await run_blocking(
             bug_localization_BM25_and_FAISS_agent.run,
-            bug_id, extended_q, top_n_documents,
-            bm25_index, faiss_index, processed_documents,
-            bm25_weight, faiss_weight
+            bug_id, extended_q, ctx.top_n_documents,
+            ctx.bm25_index, ctx.faiss_index, ctx.processed_documents,
+            ctx.bm25_weight, ctx.faiss_weight
         )
         with open(os.path.join(out_dir, f"{bug_id}_extended_basic_query_result.txt"), "w", encoding="utf-8") as f:
             f.write(extended_res.get("file_content", ""))
-        await log_event("LOCALIZE", bug_id, "extended done", project_id)
+        await log_event(ctx, "LOCALIZE", bug_id, "extended done")
 
-        localization_queue.task_done()
+        ctx.localization_queue.task_done()
 
 async def main_async(project_id, bug_reports_root, constructed_query_root, search_result_path, source_code_dir, bm25_faiss_dir):
-    global read_queue, process_queue, localization_queue
-    global bm25_index, faiss_index
-
-    read_queue = asyncio.Queue()
-    process_queue = asyncio.Queue()
-    localization_queue = asyncio.Queue()
-
     # bm25_index, faiss_index, processed_documents = index_source_code_agent.run(source_code_dir, f"project{project_id}", bm25_faiss_dir).get("file_content", "")
     # top_n_documents = len(processed_documents)
 
+    ctx = PipelineCtx(
+        project_id=project_id,
+        constructed_base=os.path.join(constructed_query_root, project_id+"_no_stem"),
+        search_base=os.path.join(search_result_path, project_id),
+        process_pool=ProcessPoolExecutor(max_workers=process_workers, mp_context=multiprocessing.get_context("spawn")),
+    )
+
     bug_path = os.path.join(bug_reports_root, project_id)
-    constructed_base = os.path.join(constructed_query_root, project_id+"_no_stem")
-    search_base = os.path.join(search_result_path, project_id)
-    os.makedirs(constructed_base, exist_ok=True)
-    os.makedirs(search_base, exist_ok=True)
+    os.makedirs(ctx.constructed_base, exist_ok=True)
+    os.makedirs(ctx.search_base, exist_ok=True)
+    # one log per project: the projects run in separate processes, each with its own log writer
     os.makedirs("./logs/parallel_logs", exist_ok=True)
-
-    for bug_id in os.listdir(bug_path):
-        bug_dir = os.path.join(bug_path, bug_id)
-        if os.path.isdir(bug_dir):
-            await read_queue.put((bug_dir, bug_id))
+    log_path = f"./logs/parallel_logs/NLP_log_{project_id}.txt"
+    open(log_path, "w").close()
 
     workers = [
-        asyncio.create_task(read_worker(project_id)),
-        asyncio.create_task(process_worker(constructed_base, project_id)),
-        #*[asyncio.create_task(localize_worker(search_base, top_n_documents, processed_documents, project_id)) for _ in range(4)],
+        *[asyncio.create_task(read_worker(ctx)) for _ in range(read_workers)],
+        *[asyncio.create_task(process_worker(ctx)) for _ in range(process_workers)],
+        #*[asyncio.create_task(localize_worker(ctx)) for _ in range(4)],
+        asyncio.create_task(log_writer(ctx.log_queue, log_path)),
     ]
+    # Fill read queue with bug IDs, the workers are already running since the queue is bounded
+    # scandir entries carry their type, no extra stat per bug folder
+    with os.scandir(bug_path) as entries:
+        bug_dirs = [(entry.path, entry.name) for entry in entries if entry.is_dir()]
+    for bug_dir, bug_id in bug_dirs:
+        await ctx.read_queue.put((bug_dir, bug_id))
 
-    await read_queue.join()
-    await process_queue.join()
-    await localization_queue.join()
+    await join_queues([ctx.read_queue, ctx.process_queue, ctx.localization_queue, ctx.log_queue], workers)
 
     for w in workers:
         w.cancel()
+    ctx.process_pool.shutdown()
+
+def run_project(project_id, bug_reports_root, constructed_query_root, search_result_path, source_codes_root, bm25_faiss_dir):
+    '''Runs the whole pipeline for one project, in its own process so several projects can run at once'''
+    print(f"\n=== Processing Project {project_id} with NLP ===")
+    
+    # Find the source code directory for this project
+    project_source_dir = os.path.join(source_codes_root, f"Project{project_id}")
+    
+    # Find the actual source directory (exclude Corpus directory)
+    if os.path.exists(project_source_dir):
+        with os.scandir(project_source_dir) as entries:
+            subdirs = [entry.name for entry in entries if entry.is_dir() and entry.name != "Corpus"]
+        if subdirs:
+            # Take the first non-Corpus subdirectory as the source directory
+            source_code_dir = os.path.join(project_source_dir, subdirs[0])
+            # If there's a 'src' directory inside, use that
+            src_dir = os.path.join(source_code_dir, "src")
+            if os.path.exists(src_dir):
+                source_code_dir = src_dir
+        else:
+            source_code_dir = project_source_dir
+    else:
+        print(f"Warning: Source code directory not found for Project {project_id}")
+        return
+    
+    print(f"Using source code directory: {source_code_dir}")
+    
+    asyncio.run(main_async(project_id, bug_reports_root, constructed_query_root, 
+                           search_result_path, source_code_dir, bm25_faiss_dir))
+    
+    print(f"=== Completed Project {project_id} ===")
+
 
 if __name__ == "__main__":
     # Define base paths for AgentProjectData
@@ -146,39 +213,15 @@ if __name__ == "__main__":
      #           "351","365","366","371","384","393","401","409","416","422","423","438","442","446","456","463","481","487","492","496","498","508","525","527"]
      #           "528","538","558","582","595","599","614","623","639","643","652","654"]
     projects = ["668","675","681","694","696","699","710","715","736","742","747","760","795"]
-    # Clear the log file at the start
-    os.makedirs("./logs/parallel_logs", exist_ok=True)
-    open("./logs/parallel_logs/NLP_log.txt", "w").close()
     
+    # Each project runs in its own process: the pipeline queues and pool are per process
     async def process_all_projects():
-        for project_id in projects:
-            print(f"\n=== Processing Project {project_id} with NLP ===")
-            
-            # Find the source code directory for this project
-            project_source_dir = os.path.join(source_codes_root, f"Project{project_id}")
-            
-            # Find the actual source directory (exclude Corpus directory)
-            if os.path.exists(project_source_dir):
-                subdirs = [d for d in os.listdir(project_source_dir) 
-                          if os.path.isdir(os.path.join(project_source_dir, d)) and d != "Corpus"]
-                if subdirs:
-                    # Take the first non-Corpus subdirectory as the source directory
-                    source_code_dir = os.path.join(project_source_dir, subdirs[0])
-                    # If there's a 'src' directory inside, use that
-                    src_dir = os.path.join(source_code_dir, "src")
-                    if os.path.exists(src_dir):
-                        source_code_dir = src_dir
-                else:
-                    source_code_dir = project_source_dir
-            else:
-                print(f"Warning: Source code directory not found for Project {project_id}")
-                continue
-            
-            print(f"Using source code directory: {source_code_dir}")
-            
-            await main_async(project_id, bug_reports_root, constructed_query_root, 
-                           search_result_path, source_code_dir, bm25_faiss_dir)
-            
-            print(f"=== Completed Project {project_id} ===")
+        loop = asyncio.get_running_loop()
+        with ProcessPoolExecutor(max_workers=project_workers, mp_context=multiprocessing.get_context("spawn")) as project_pool:
+            await asyncio.gather(*[
+                loop.run_in_executor(project_pool, run_project, project_id, bug_reports_root, constructed_query_root,
+                                     search_result_path, source_codes_root, bm25_faiss_dir)
+                for project_id in projects
+            ])
     
     asyncio.run(process_all_projects())
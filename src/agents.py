@@ -1,11 +1,47 @@
 # Agent class for simplicity
 from tools import (
-    readFile, processBugReportContent, preprocess_text, load_stopwords, processBugReportQueryKeyBERT, processBugReportQueryReasoning,
+    readFile, processBugReportContent, processBugReportContent_batch, preprocess_text, load_stopwords, processBugReportQueryKeyBERT, processBugReportQueryKeyBERT_batch, processBugReportQueryReasoning,
     processBugReportContentPostReasoning, processBugReportQueryReasoningReflectOnResults,
-    index_source_code, bug_localization_BM25_and_FAISS, get_short_filename
+    index_source_code, bug_localization_BM25_and_FAISS, bug_localization_BM25_and_FAISS_batch, get_short_filename
 )
 from litellm import completion
 from typing import Callable
+import functools
+
+# Set to True to print the prompt each agent would send to the LLM
+DEBUG = False
+
+# Tool each agent dispatches to, resolved once when the agent is created
+AGENT_TOOLS = {
+    "readBugReportContent_agent": "readFile",
+    "process_bug_report_content_agent": "processBugReportContent",
+    "process_bug_report_content_batch_agent": "processBugReportContent_batch",
+    "process_bug_report_query_keybert_agent": "processBugReportQueryKeyBERT",
+    "process_bug_report_query_keybert_batch_agent": "processBugReportQueryKeyBERT_batch",
+    "process_bug_report_query_reasoning_agent": "processBugReportQueryReasoning",
+    "process_bug_report_content_agent_post_reasoning": "processBugReportContentPostReasoning",
+    "process_bug_report_query_reasoning_reflects_on_results_agent": "processBugReportQueryReasoningReflectOnResults",
+    "index_source_code_agent": "index_source_code",
+    "bug_localization_BM25_and_FAISS_agent": "bug_localization_BM25_and_FAISS",
+    "bug_localization_BM25_and_FAISS_batch_agent": "bug_localization_BM25_and_FAISS_batch",
+}
+
+def unknown_agent(*args):
+    return "Unknown agent."
+
+def run_tool(tool, output_key, *args):
+    """Body of Agent.run once the tool is known, bound per agent with functools.partial."""
+    try:
+        return {output_key: tool(*args)}
+    except Exception as e:
+        return {output_key: f"Error: {e}"}
+
+def run_tool_raw(tool, *args):
+    """Body of Agent.run_raw: the tool output itself, or the error message, without the output_key dict."""
+    try:
+        return tool(*args)
+    except Exception as e:
+        return f"Error: {e}"
 
 class Agent:
     def __init__(self, model: Callable, name: str, instruction: str, tools: list, output_key: str):
@@ -14,43 +50,28 @@ class Agent:
         self.instruction = instruction
         self.tools = {tool.__name__: tool for tool in tools}
         self.output_key = output_key
+        self._tool = self.tools.get(AGENT_TOOLS.get(name), unknown_agent)
+        if not DEBUG:
+            # specialized run: no prompt, no attribute lookups, and it pickles without the agent for the process pool
+            self.run = functools.partial(run_tool, self._tool, output_key)
+            self.run_raw = functools.partial(run_tool_raw, self._tool)
 
     def run(self, *args):
-        try:
-            # Construct prompt
-            full_prompt = f"""{self.instruction}
+        # only reached with DEBUG set, otherwise __init__ replaced it
+        full_prompt = f"""{self.instruction}
 
 User Input:
 Arguments: {args}
 
 Now decide which tool to use.
 """
-            print(f"Sending prompt to LLM:\n{full_prompt}\n")
-
-            # Simulate choosing a tool based on the instruction
-            if self.name == "readBugReportContent_agent":
-                tool_output = self.tools["readFile"](*args)
-            elif self.name == "process_bug_report_content_agent":
-                tool_output = self.tools["processBugReportContent"](*args)
-            elif self.name == "process_bug_report_query_keybert_agent":
-                tool_output = self.tools["processBugReportQueryKeyBERT"](*args)
-            elif self.name == "process_bug_report_query_reasoning_agent":
-                tool_output = self.tools["processBugReportQueryReasoning"](*args)
-            elif self.name == "process_bug_report_content_agent_post_reasoning":
-                tool_output = self.tools["processBugReportContentPostReasoning"](*args)
-            elif self.name == "process_bug_report_query_reasoning_reflects_on_results_agent":
-                tool_output = self.tools["processBugReportQueryReasoningReflectOnResults"] (*args)
-            elif self.name == "index_source_code_agent":
-                tool_output = self.tools["index_source_code"](*args)
-            elif self.name == "bug_localization_BM25_and_FAISS_agent":
-                tool_output = self.tools["bug_localization_BM25_and_FAISS"](*args)
-            else:
-                tool_output = "Unknown agent."
-
-            return {self.output_key: tool_output}
-
-        except Exception as e:
-            return {self.output_key: f"Error: {e}"}
+        print(f"Sending prompt to LLM:\n{full_prompt}\n")
+
+        return run_tool(self._tool, self.output_key, *args)
+
+    def run_raw(self, *args):
+        # same as run without the {output_key: ...} wrapping, for the per-bug hot paths
+        return self.run(*args)[self.output_key]
         
 
 
@@ -78,6 +99,17 @@ try:
         output_key="file_content"
     )
 
+    processBugReportContent_batch_agent = Agent(
+        model=MY_MODEL,
+        name="process_bug_report_content_batch_agent",
+        instruction="You are the ProcessBugReportContentBatch Agent."
+                    "You will receive a list of outputs ('result') of the 'readBugReportContent_agent'."
+                    "Your ONLY task is to process all contents at once and return one string per content."
+                    "Use the 'processBugReportContent_batch' tool to perform this action. ",
+        tools=[processBugReportContent_batch, preprocess_text, load_stopwords],
+        output_key="file_content"
+    )
+
     processBugReportContentPostReasoning_agent = Agent(
         model=MY_MODEL,
         name="process_bug_report_content_agent_post_reasoning",
@@ -102,6 +134,18 @@ try:
         tools=[processBugReportQueryKeyBERT], # List of tools the agent can use
         output_key="file_content" # Specify the output key for the tool's result
         )
+
+    processBugReportQueryKeyBERT_batch_agent = Agent(
+        model=MY_MODEL,
+        name="process_bug_report_query_keybert_batch_agent",
+        instruction="You are the ProcessBugReportQueryKeyBERTBatch Agent."
+                    "You will receive a list of outputs ('result') of the 'processBugReportContent_agent'."
+                    "You will also receive a number ('top_n') which is the number of keywords to extract from each of them."
+                    "Your ONLY task is to process all contents at once and return one list of keywords per content."
+                    "Use the 'processBugReportQueryKeyBERT_batch' tool to perform this action. ",
+        tools=[processBugReportQueryKeyBERT_batch],
+        output_key="file_content"
+        )
     
     processBugReportQueryReasoning_agent = Agent(
         model=MY_MODEL,     
@@ -150,5 +194,18 @@ try:
         tools=[bug_localization_BM25_and_FAISS, get_short_filename],
         output_key="file_content"
     )
+
+    bug_localization_BM25_and_FAISS_batch_agent = Agent(
+        model=MY_MODEL,
+        name="bug_localization_BM25_and_FAISS_batch_agent",
+        instruction="You are the BugLocalizationBM25AndFAISSBatch Agent. "
+                    "You will receive a list of bug IDs ('bug_ids') and a list of queries ('bug_report_queries'), one query per bug ID. "
+                    "You will also receive a number ('top_n') which is the number of documents to retrieve. "
+                    "You will also receive a BM25 index ('bm25_index') and a FAISS index ('faiss_index') from the 'index_source_code_agent'. "
+                    "Your ONLY task is to localize all queries at once using the 'bug_localization_BM25_and_FAISS_batch' tool. "
+                    "Return one result string per query, each with one result on a new line.",
+        tools=[bug_localization_BM25_and_FAISS_batch, get_short_filename],
+        output_key="file_content"
+    )
 except Exception as e:
     print(f"Self-test failed for agent setup. Error: {e}")
@@ -1,5 +1,9 @@
 import os
+import sys
+import math
 import itertools
+import functools
+from concurrent.futures import ProcessPoolExecutor
 from collections import defaultdict
 
 # folder where all projects source codes are contained
@@ -20,6 +24,20 @@ project_mapping = {
     "24": "mobile-wallet"
 }
 
+# cutoffs of the Hit@K evaluators
+hit_at_k_cutoffs = (1, 5, 10)
+
+# ranks of the groundtruth files among the retrieved files and their Average Precision (AP), in one pass
+def rank_groundtruth(retrieved_files, groundtruth_set):
+    ranks = []
+    precision_sum = 0
+    for i, file in enumerate(retrieved_files):
+        if file in groundtruth_set:
+            ranks.append(i + 1)
+            precision_sum += len(ranks) / (i + 1)
+    average_precision = precision_sum / len(ranks) if ranks else 0
+    return ranks, average_precision
+
 # compute all query evaluators
 def compute_evaluation(groundtruth_data, search_data):
 
@@ -33,8 +51,9 @@ def compute_evaluation(groundtruth_data, search_data):
     bug_report_ranks = []
     total_queries = 0
     
-    hit_at_k_baseline = {1: 0, 5: 0, 10: 0}
-    hit_at_k_extended = {1: 0, 5: 0, 10: 0}
+    # hit counts in hit_at_k_cutoffs order
+    hit_at_k_baseline = [0] * len(hit_at_k_cutoffs)
+    hit_at_k_extended = [0] * len(hit_at_k_cutoffs)
     
     mrr_baseline_sum = 0
     mrr_extended_sum = 0
@@ -42,16 +61,16 @@ def compute_evaluation(groundtruth_data, search_data):
     map_baseline_sum = 0
     map_extended_sum = 0
     
-    # iterate over each baseline query, gathering both the baseline and extended queries
-    for query, search_results in search_data.items():
+    # bound once instead of looked up (or built) again for every bug
+    inf = math.inf
+    no_groundtruth = (frozenset(), 0)
+    get_groundtruth = groundtruth_data.get
     
-        query_name, query_type = query
-        if query_type != 'baseline':
-            continue
-        extended_results = search_data[(query_name, 'extended')]
+    # iterate over each bug, with both its baseline and extended query results
+    for query_name, search_results, extended_results in search_data:
         
         # gather the groundtruth data for comparison against search results
-        groundtruth_set, missing_truth_count = groundtruth_data.get(query_name, (set(), 0))
+        groundtruth_set, missing_truth_count = get_groundtruth(query_name, no_groundtruth)
         
         # prevent further calculations if no groundtruth exists
         if not groundtruth_set:
@@ -61,16 +80,17 @@ def compute_evaluation(groundtruth_data, search_data):
             bug_reports_affected.append(query_name)
         
         # gather the search results for comparison against groundtruth data
-        baseline_files = [result.split(',')[0] for result in search_results]
-        extended_files = [result.split(',')[0] for result in extended_results]
+        # (parse_search_results already kept only the file name column)
+        baseline_files = search_results
+        extended_files = extended_results
         
-        # compute all baseline and extended ranks
-        baseline_ranks = [i + 1 for i, result in enumerate(baseline_files) if result in groundtruth_set]
-        extended_ranks = [i + 1 for i, result in enumerate(extended_files) if result in groundtruth_set]
+        # compute all baseline and extended ranks, with their AP
+        baseline_ranks, ap_baseline = rank_groundtruth(baseline_files, groundtruth_set)
+        extended_ranks, ap_extended = rank_groundtruth(extended_files, groundtruth_set)
 
         # Retrieve the first rank if available, otherwise set to None
-        baseline_rank = baseline_ranks[0] if baseline_ranks else float('inf')
-        extended_rank = extended_ranks[0] if extended_ranks else float('inf')
+        baseline_rank = baseline_ranks[0] if baseline_ranks else inf
+        extended_rank = extended_ranks[0] if extended_ranks else inf
         
         # store individual ranks (lists of all ranks found)
         bug_report_ranks.append({
@@ -88,49 +108,29 @@ def compute_evaluation(groundtruth_data, search_data):
             worse_count += 1
         
         # calculate mrr
-        if baseline_rank != float('inf'):
+        if baseline_rank != inf:
             mrr_baseline_sum += 1 / baseline_rank
-        if extended_rank != float('inf'):
+        if extended_rank != inf:
             mrr_extended_sum += 1 / extended_rank
         
-        # Calculate Average Precision (AP) for baseline and extended queries
-        def calculate_average_precision(retrieved_files):
-            hits = 0
-            precision_sum = 0
-            for i, file in enumerate(retrieved_files):
-                if file in groundtruth_set:
-                    hits += 1
-                    precision = hits / (i + 1)
-                    precision_sum += precision
-            return precision_sum / hits if hits > 0 else 0
-        
-        ap_baseline = calculate_average_precision(baseline_files)
-        ap_extended = calculate_average_precision(extended_files)
-        
         map_baseline_sum += ap_baseline
         map_extended_sum += ap_extended
         
-        # Calculate Hit@K for baseline
-        for k in hit_at_k_baseline:
-            if any(result in groundtruth_set for result in baseline_files[:k]):
-                hit_at_k_baseline[k] += 1
+        # Calculate Hit@K for baseline: a groundtruth file is in the top k when the first one is
+        for i, k in enumerate(hit_at_k_cutoffs):
+            if baseline_rank <= k:
+                hit_at_k_baseline[i] += 1
         
         # Calculate Hit@K for extended
-        for k in hit_at_k_extended:
-            if any(result in groundtruth_set for result in extended_files[:k]):
-                hit_at_k_extended[k] += 1
+        for i, k in enumerate(hit_at_k_cutoffs):
+            if extended_rank <= k:
+                hit_at_k_extended[i] += 1
         
         total_queries += 1
     
-    # compute k percentages
-    hit_at_k_baseline_percent = {
-        k: (count / total_queries) * 100 if total_queries != 0 else 0 
-        for k, count in hit_at_k_baseline.items()
-    }
-    hit_at_k_extended_percent = {
-        k: (count / total_queries) * 100 if total_queries != 0 else 0 
-        for k, count in hit_at_k_extended.items()
-    }
+    # compute k percentages, as tuples in hit_at_k_cutoffs order
+    hit_at_k_baseline_percent = tuple((count / total_queries) * 100 if total_queries != 0 else 0 for count in hit_at_k_baseline)
+    hit_at_k_extended_percent = tuple((count / total_queries) * 100 if total_queries != 0 else 0 for count in hit_at_k_extended)
 
     # Calculate final MRR by dividing the sum by the total number of queries
     mrr_baseline = mrr_baseline_sum / total_queries if total_queries > 0 else 0
@@ -155,6 +155,24 @@ def compute_evaluation(groundtruth_data, search_data):
         'map_extended': map_extended
     }
 
+# convert the dots of a dotted file name to path separators, except the one of the file extension
+# (memoized: the same files come back for every bug, query variant and query type)
+@functools.lru_cache(maxsize=1 << 16)
+def dotted_to_path(dotted_path):
+    head, dot, extension = dotted_path.rpartition('.')
+    # no dot or only the extension one: nothing to convert, keep the string as is
+    if '.' not in head:
+        return dotted_path
+    return head.replace('.', os.sep) + dot + extension
+
+# normalize a search result file name: remove the project prefix and convert it to path format
+# (interned like the groundtruth paths, so a matching lookup compares the same string object)
+@functools.lru_cache(maxsize=1 << 16)
+def normalize_search_filename(filename, project_name):
+    if filename.startswith(f'{project_name}.'):
+        filename = filename[len(project_name)+1:]
+    return sys.intern(dotted_to_path(filename))
+
 def generate_possible_paths(dotted_path):
     parts = dotted_path.split('.')
     base_parts, extension = parts[:-1], parts[-1]
@@ -170,11 +188,48 @@ def generate_possible_paths(dotted_path):
     
     return all_paths
 
-# read and format the groundtruth to a dictionary
-def parse_groundtruth(groundtruth_file, groundtruth_found_file, source_code_root, search_data):
+# list every file and folder under the source code root once, relative to it,
+# so checking the possible paths of a groundtruth file is a set lookup instead of one stat each.
+# Symlinked folders are followed, as os.path.exists does, but a folder leading back to one above it is not entered.
+# Returns the listed paths and the function mapping a possible path to its key in them
+def list_source_paths(source_code_root):
+    source_paths = set()
+    root_stat = os.stat(source_code_root)
+    # (st_dev, st_ino) of every folder from the root down to each folder still to walk
+    ancestors = {source_code_root: {(root_stat.st_dev, root_stat.st_ino)}}
+    for dirpath, dirnames, filenames in os.walk(source_code_root, followlinks=True):
+        rel_dir = os.path.relpath(dirpath, source_code_root)
+        prefix = "" if rel_dir == os.curdir else rel_dir + os.sep
+        source_paths.update(os.path.normcase(prefix + name) for name in dirnames)
+        source_paths.update(os.path.normcase(prefix + name) for name in filenames)
+
+        above = ancestors.pop(dirpath)
+        walked = []
+        for name in dirnames:
+            try:
+                st = os.stat(os.path.join(dirpath, name))
+            except OSError:
+                continue
+            if (st.st_dev, st.st_ino) not in above:
+                ancestors[os.path.join(dirpath, name)] = above | {(st.st_dev, st.st_ino)}
+                walked.append(name)
+        dirnames[:] = walked
 
-    # these are the only bug reports to consider for evaluation
-    bug_reports_with_queries = {key[0] for key in search_data.keys()}
+    # normcase only folds case on Windows: a case-insensitive file system elsewhere (macOS) is detected
+    # from one listed path, and then the listing is lowercased
+    path_key = os.path.normcase
+    for path in source_paths:
+        swapped = path.swapcase()
+        if swapped != path:
+            if swapped not in source_paths and os.path.exists(os.path.join(source_code_root, swapped)):
+                source_paths = {path.lower() for path in source_paths}
+                path_key = lambda possible_path: os.path.normcase(possible_path).lower()
+            break
+    return source_paths, path_key
+
+# read and format the groundtruth to a dictionary
+# (the same for every query type of a project, so it is parsed once per project)
+def parse_groundtruth(groundtruth_file, groundtruth_found_file, source_code_root):
 
     # Read the groundtruthFound file to get valid bug IDs
     valid_bug_ids = set()
@@ -184,6 +239,10 @@ def parse_groundtruth(groundtruth_file, groundtruth_found_file, source_code_root
             if bug_id:
                 valid_bug_ids.add(bug_id)
 
+    source_paths, path_key = list_source_paths(source_code_root)
+    # bugs often share groundtruth files: each dotted path is resolved against the source code once
+    found_paths = {}
+
     # datasets to keep track of necessary groundtruth data
     groundtruth_data = {}
     all_groundtruth = set()
@@ -216,28 +275,24 @@ def parse_groundtruth(groundtruth_file, groundtruth_found_file, source_code_root
             for _ in range(num_lines):
                 line = file.readline().strip()
                 
-                # Generate all possible paths from the dot notation
-                possible_paths = generate_possible_paths(line)
-                
-                # Check which path actually exists in the source code directory
-                found_path = None
-                for possible_path in possible_paths:
-                    full_path = os.path.join(source_code_root, possible_path)
-                    if os.path.exists(full_path):
-                        found_path = possible_path
-                        break
+                if line in found_paths:
+                    found_path = found_paths[line]
+                else:
+                    # Generate all possible paths from the dot notation
+                    possible_paths = generate_possible_paths(line)
+                    
+                    # Check which path actually exists in the source code directory
+                    found_path = None
+                    for possible_path in possible_paths:
+                        if path_key(possible_path) in source_paths:
+                            found_path = possible_path
+                            break
+                    found_paths[line] = found_path
                 
                 if found_path:
                     # File exists - normalize the path to match search results format
                     # Convert dots to path separators in path components (except file extension)
-                    path_parts = found_path.split('.')
-                    if len(path_parts) > 1:
-                        # Keep the extension as is, convert dots to path separators in the rest
-                        normalized_path = os.sep.join(path_parts[:-1]) + '.' + path_parts[-1]
-                    else:
-                        normalized_path = found_path
-                    
-                    groundtruth_entries.add(normalized_path)
+                    groundtruth_entries.add(sys.intern(dotted_to_path(found_path)))
                     all_groundtruth.add(os.path.join(source_code_root, found_path))
                 else:
                     # No valid path found - mark as missing
@@ -251,9 +306,8 @@ def parse_groundtruth(groundtruth_file, groundtruth_found_file, source_code_root
             elif non_existent_count > 0:
                 bugs_some_missing.append(query_name)
             
-            # store the formatted data in a dictionary (only for bugs with queries for evaluation)
-            if query_name in bug_reports_with_queries:
-                groundtruth_data[query_name] = (groundtruth_entries, non_existent_count)
+            # store the formatted data in a dictionary
+            groundtruth_data[query_name] = (frozenset(groundtruth_entries), non_existent_count)
     
     # Total bugs = number of bugs in groundtruthFound file
     total_bugs = len(valid_bug_ids)
@@ -263,60 +317,109 @@ def parse_groundtruth(groundtruth_file, groundtruth_found_file, source_code_root
     
     return groundtruth_data, len(all_groundtruth), len(missing_groundtruth), total_bugs, bugs_all_missing, bugs_some_missing, total_considered_bugs
 
-# read and format the stored query search results to a dictionary
+# size of a stored search result file, None if it does not exist (one stat, like the existence check)
+def result_file_size(result_file):
+    try:
+        return os.stat(result_file).st_size
+    except FileNotFoundError:
+        return None
+
+# read the file names of a stored search result file, normalized to path format
+def read_search_result_file(result_file, project_name):
+    with open(result_file, 'r') as file:
+        data = file.read()
+    # one read per file, and only the file name column is split off each line
+    return [normalize_search_filename(parts[1].strip(), project_name)
+            for parts in (line.split(',', 2) for line in data.splitlines())
+            if len(parts) >= 2]
+
+# read the stored query search results as a list of (bug id, baseline results, extended results)
 def parse_search_results(search_results_dir, query_type, project_name):
-    search_data = {}
+    search_data = []
     
-    # iterate through each bug directory
-    for bug_id in os.listdir(search_results_dir):
-        bug_dir = os.path.join(search_results_dir, bug_id)
-        if not os.path.isdir(bug_dir):
-            continue
-            
-        # load baseline results
+    # iterate through each bug directory (scandir entries carry their type, no extra stat per entry)
+    with os.scandir(search_results_dir) as entries:
+        bug_dirs = [(entry.name, entry.path) for entry in entries if entry.is_dir()]
+    for bug_id, bug_dir in bug_dirs:
+        # load baseline and extended results, a bug is only evaluated when it has both
         baseline_file = os.path.join(bug_dir, f"{bug_id}_baseline_{query_type}_query_result.txt")
-        if os.path.exists(baseline_file):
-            baseline_results = []
-            with open(baseline_file, 'r') as file:
-                for line in file:
-                    line = line.strip()
-                    if line:
-                        parts = line.split(',')
-                        if len(parts) >= 2:
-                            filename = parts[1].strip()
-                            # normalize filename: remove project prefix and convert to path format
-                            if filename.startswith(f'{project_name}.'):
-                                filename = filename[len(project_name)+1:]
-                            # convert remaining dots to path separators except for file extension
-                            filename_parts = filename.split('.')
-                            if len(filename_parts) > 1:
-                                filename = os.path.join(*filename_parts[:-1]) + '.' + filename_parts[-1]
-                            baseline_results.append(filename)
-            search_data[(bug_id, 'baseline')] = baseline_results
-        
-        # load extended results  
         extended_file = os.path.join(bug_dir, f"{bug_id}_extended_{query_type}_query_result.txt")
-        if os.path.exists(extended_file):
-            extended_results = []
-            with open(extended_file, 'r') as file:
-                for line in file:
-                    line = line.strip()
-                    if line:
-                        parts = line.split(',')
-                        if len(parts) >= 2:
-                            filename = parts[1].strip()
-                            # normalize filename: remove project prefix and convert to path format
-                            if filename.startswith(f'{project_name}.'):
-                                filename = filename[len(project_name)+1:]
-                            # convert remaining dots to path separators except for file extension
-                            filename_parts = filename.split('.')
-                            if len(filename_parts) > 1:
-                                filename = os.path.join(*filename_parts[:-1]) + '.' + filename_parts[-1]
-                            extended_results.append(filename)
-            search_data[(bug_id, 'extended')] = extended_results
+        baseline_size = result_file_size(baseline_file)
+        extended_size = result_file_size(extended_file)
+        if baseline_size is not None and extended_size is not None:
+            # an empty file has no results, it is not opened
+            search_data.append((bug_id, read_search_result_file(baseline_file, project_name) if baseline_size else [],
+                                read_search_result_file(extended_file, project_name) if extended_size else []))
             
     return search_data
 
+def evaluate_query_type(project_id, project_name, query_type, search_results_dir, groundtruth, project_evaluation_dir):
+    """Evaluate the search results of one query type against the parsed groundtruth and store its evaluation file"""
+    print(f"Starting evaluation for Project {project_id} - {query_type}")
+    
+    # gather the search results data
+    search_data = parse_search_results(search_results_dir, query_type, project_name)
+    print(f"Found search results for {len(search_data)} bugs")
+    
+    # gather the groundtruth data of the bug reports with queries, the only ones to consider for evaluation
+    # (paths interned again, unpickling in this process does not intern them)
+    all_groundtruth_data, total_groundtruth_count, missing_groundtruth_count, total_bugs, bugs_all_missing, bugs_some_missing, total_considered_bugs = groundtruth
+    bug_reports_with_queries = {bug_id for bug_id, _, _ in search_data}
+    groundtruth_data = {query_name: (frozenset(map(sys.intern, groundtruth_set)), missing_truth_count)
+                        for query_name, (groundtruth_set, missing_truth_count) in all_groundtruth_data.items()
+                        if query_name in bug_reports_with_queries}
+    print(f"Found {len(groundtruth_data)} groundtruth entries")
+    
+    # compute all query evaluators
+    data = compute_evaluation(groundtruth_data, search_data)
+    
+    # save search results
+    bug_reports_considered_count = len(data['bug_report_ranks'])
+    
+    storage_path = os.path.join(project_evaluation_dir, f"evaluation_{query_type.lower()}.txt")
+    
+    # the whole report is built first and written with a single call
+    report = [
+        f"Project {project_id} ({project_name}):\n\n",
+        f"Total number of groundtruth files: {total_groundtruth_count}\n",
+        f"Total number of bugs: {total_bugs}\n",
+        f"Total amount of groundtruth files not found in source code: {missing_groundtruth_count}\n",
+
+        f"Total number of Bug reports where all groundtruth files do not exist: {len(bugs_all_missing)}\n",
+        f"Bug reports where all groundtruth files do not exist: {bugs_all_missing}\n",
+
+        f"Total number of bug reports where some groundtruth files were missing: {len(bugs_some_missing)}\n",
+        f"Bug reports where some groundtruth files were missing: {bugs_some_missing}\n",
+
+        f"Total number of considered bugs: {total_considered_bugs}\n",
+
+        f"\nQE Improved Count: {data['improvement_count']}\n",
+        f"QE Identical Count: {data['same_count']}\n",
+        f"QE Worse Count: {data['worse_count']}\n",
+
+        f"\nHit@K for baseline queries:\n",
+        *[f"Hit@{k}: {percentage:.2f}%\n" for k, percentage in zip(hit_at_k_cutoffs, data['hit_at_k_baseline_percent'])],
+
+        f"\nHit@K for extended queries:\n",
+        *[f"Hit@{k}: {percentage:.2f}%\n" for k, percentage in zip(hit_at_k_cutoffs, data['hit_at_k_extended_percent'])],
+
+        f"\nMRR baseline queries: {data['mrr_baseline']}\n",
+        f"MRR extended queries: {data['mrr_extended']}\n",
+
+        f"\nMAP baseline queries: {data['map_baseline']}\n",
+        f"MAP extended queries: {data['map_extended']}\n",
+
+        "\nIndividual Results:\n",
+    ]
+    for rank_info in data['bug_report_ranks']:
+        report.append(f"{rank_info['query_name']}, 'Baseline', {rank_info['baseline_rank']}\n")
+        report.append(f"{rank_info['query_name']}, 'Extended', {rank_info['extended_rank']}\n")
+
+    with open(storage_path, 'w') as file:
+        file.write("".join(report))
+
+    print(f"Stored evaluation for Project {project_id} - {query_type} to {storage_path}")
+
 def evaluate_project(project_id, project_name):
     """Evaluate a single project and generate evaluation files"""
     
@@ -329,98 +432,49 @@ def evaluate_project(project_id, project_name):
     # find the path to the source code and corpus
     source_corpus = None
     source_code_root = None
-    for file in os.listdir(source_path):
-        if file.startswith("Corpus"):
-            source_corpus = os.path.join(source_path, file)
-        elif file == project_name:
-            source_code_root = os.path.join(source_path, file)
+    with os.scandir(source_path) as entries:
+        for entry in entries:
+            if entry.name.startswith("Corpus"):
+                source_corpus = entry.path
+            elif entry.name == project_name:
+                source_code_root = entry.path
     
     if not source_corpus or not source_code_root:
         print(f"Error with groundtruth location:{source_corpus} or source code location:{source_code_root}")
         return
     
     # find the path to the groundtruth file
-    groundtruth_file = None
-    groundtruth_found_file = None
-    for file in os.listdir(source_corpus):
-        if file.startswith("groundtruth_"):
-            groundtruth_file = file
-        elif file.startswith("groundtruthFound_"):
-            groundtruth_found_file = file
-    
-    if not groundtruth_file:
+    groundtruth_path = None
+    groundtruth_found_path = None
+    with os.scandir(source_corpus) as entries:
+        for entry in entries:
+            if entry.name.startswith("groundtruth_"):
+                groundtruth_path = entry.path
+            elif entry.name.startswith("groundtruthFound_"):
+                groundtruth_found_path = entry.path
+    
+    if not groundtruth_path:
         print("Error: no ground truth file found")
         return
     
-    if not groundtruth_found_file:
+    if not groundtruth_found_path:
         print("Error: no groundtruthFound file found")
         return
     
-    groundtruth_path = os.path.join(source_corpus, groundtruth_file)
-    groundtruth_found_path = os.path.join(source_corpus, groundtruth_found_file)
-    
     # Create project-specific evaluation directory
     project_evaluation_dir = os.path.join(evaluation_results_root, f"Project{project_id}")
     os.makedirs(project_evaluation_dir, exist_ok=True)
     
-    # evaluate each query type
-    for query_type in query_types:
-        print(f"Starting evaluation for Project {project_id} - {query_type}")
-        
-        # gather the search results data
-        search_data = parse_search_results(search_results_dir, query_type, project_name)
-        print(f"Found {len(search_data)} search results")
-        
-        # gather the groundtruth data
-        groundtruth_data, total_groundtruth_count, missing_groundtruth_count, total_bugs, bugs_all_missing, bugs_some_missing, total_considered_bugs = parse_groundtruth(groundtruth_path, groundtruth_found_path, source_code_root, search_data)
-        print(f"Found {len(groundtruth_data)} groundtruth entries")
-        
-        # compute all query evaluators
-        data = compute_evaluation(groundtruth_data, search_data)
-        
-        # save search results
-        bug_reports_considered_count = len(data['bug_report_ranks'])
-        
-        storage_path = os.path.join(project_evaluation_dir, f"evaluation_{query_type.lower()}.txt")
-        
-        with open(storage_path, 'w') as file:
-            file.write(f"Project {project_id} ({project_name}):\n\n")
-            file.write(f"Total number of groundtruth files: {total_groundtruth_count}\n")
-            file.write(f"Total number of bugs: {total_bugs}\n")
-            file.write(f"Total amount of groundtruth files not found in source code: {missing_groundtruth_count}\n")
-            
-            file.write(f"Total number of Bug reports where all groundtruth files do not exist: {len(bugs_all_missing)}\n")
-            file.write(f"Bug reports where all groundtruth files do not exist: {bugs_all_missing}\n")
-            
-            file.write(f"Total number of bug reports where some groundtruth files were missing: {len(bugs_some_missing)}\n")
-            file.write(f"Bug reports where some groundtruth files were missing: {bugs_some_missing}\n")
-            
-            file.write(f"Total number of considered bugs: {total_considered_bugs}\n")
-            
-            file.write(f"\nQE Improved Count: {data['improvement_count']}\n")
-            file.write(f"QE Identical Count: {data['same_count']}\n")
-            file.write(f"QE Worse Count: {data['worse_count']}\n")
-    
-            file.write(f"\nHit@K for baseline queries:\n")
-            for k, percentage in data['hit_at_k_baseline_percent'].items():
-                file.write(f"Hit@{k}: {percentage:.2f}%\n")
-        
-            file.write(f"\nHit@K for extended queries:\n")
-            for k, percentage in data['hit_at_k_extended_percent'].items():
-                file.write(f"Hit@{k}: {percentage:.2f}%\n")
-                
-            file.write(f"\nMRR baseline queries: {data['mrr_baseline']}\n")
-            file.write(f"MRR extended queries: {data['mrr_extended']}\n")
-            
-            file.write(f"\nMAP baseline queries: {data['map_baseline']}\n")
-            file.write(f"MAP extended queries: {data['map_extended']}\n")
-        
-            file.write("\nIndividual Results:\n")
-            for rank_info in data['bug_report_ranks']:
-                file.write(f"{rank_info['query_name']}, 'Baseline', {rank_info['baseline_rank']}\n")
-                file.write(f"{rank_info['query_name']}, 'Extended', {rank_info['extended_rank']}\n")
-                
-        print(f"Stored evaluation for Project {project_id} - {query_type} to {storage_path}")
+    # the groundtruth is read and checked against the source code once for all query types
+    groundtruth = parse_groundtruth(groundtruth_path, groundtruth_found_path, source_code_root)
+
+    # evaluate each query type, each in its own process since they only share files read-only
+    with ProcessPoolExecutor(max_workers=len(query_types)) as executor:
+        futures = [executor.submit(evaluate_query_type, project_id, project_name, query_type, search_results_dir,
+                                   groundtruth, project_evaluation_dir)
+                   for query_type in query_types]
+        for future in futures:
+            future.result()
 
 def main():
     """Main function to evaluate all projects"""
@@ -1,28 +1,52 @@
 import os
-import asyncio, functools, time
+import asyncio, functools, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
 from query_constructions import load_image_content
+from pipeline_utils import run_in_process, join_queues, drain_queue, log_timestamp, log_writer, make_bug_dirs
+from text_preprocessing import processBugReportContent
 from agents import (
     readBugReportContent_agent,
-    processBugReportContent_agent,
-    processBugReportQueryKeyBERT_agent,
+    processBugReportQueryKeyBERT_batch_agent,
     processBugReportQueryReasoning_agent,
     processBugReportContentPostReasoning_agent,
     index_source_code_agent,
-    bug_localization_BM25_and_FAISS_agent
+    bug_localization_BM25_and_FAISS_batch_agent
 )
 
-# Queues between pipeline stages, initialized in main_async
-read_queue = process_queue = keybert_queue = reason_queue = localization_queue = None
 
-
-# Shared index data
-bm25_index = None
-faiss_index = None
+# Default settings, copied into each run's PipelineCtx
 bm25_weight = 0.3
 faiss_weight = 0.7
 top_n = 15 # Number of top keywords to retrieve
 top_n_documents = 100 # Number of top documents to retrieve, but default is 100
-query_type = None
+read_workers = 8 # Number of bug folders read concurrently
+process_workers = min(4, os.cpu_count() or 1) # Number of bug reports preprocessed in parallel, regex work needs few processes
+keybert_batch_size = 16 # Max number of bugs whose contents are encoded together
+keybert_batch_linger = 0.05 # Seconds a KeyBERT batch waits for more bugs before it is encoded
+localize_batch_size = 32 # Max number of queued query pairs searched together
+
+
+@dataclass
+class PipelineCtx:
+    '''State of one pipeline run, created in main_async and passed to every worker'''
+    output_base: str
+    search_base: str
+    bm25_index: object
+    faiss_index: object
+    processed_documents: list
+    process_pool: ProcessPoolExecutor
+    top_n: int = top_n
+    top_n_documents: int = top_n_documents
+    bm25_weight: float = bm25_weight
+    faiss_weight: float = faiss_weight
+    # bounded queues so a fast stage waits for a slow one instead of buffering every bug in memory
+    read_queue: asyncio.Queue = field(default_factory=lambda: asyncio.Queue(maxsize=2 * read_workers))
+    process_queue: asyncio.Queue = field(default_factory=lambda: asyncio.Queue(maxsize=2 * process_workers))
+    keybert_queue: asyncio.Queue = field(default_factory=lambda: asyncio.Queue(maxsize=2 * keybert_batch_size))
+    reason_queue: asyncio.Queue = field(default_factory=asyncio.Queue)
+    localization_queue: asyncio.Queue = field(default_factory=lambda: asyncio.Queue(maxsize=2 * localize_batch_size))
+    log_queue: asyncio.Queue = field(default_factory=asyncio.Queue)
 
 
 # Helper : run blocking CPU-bound code in a thread
@@ -31,86 +55,100 @@ async def run_blocking(fn, *args, **kw):
     part = functools.partial(fn, *args, **kw)
     return await loop.run_in_executor(None, part)
 
-#Helper: Log events to the pipeline_log.txt file
-log_lock = asyncio.Lock()
-async def log_event(tag, bug_id, stage):
-    ts = time.strftime("%H:%M:%S", time.localtime())
+#Helper: Log events to the pipeline_log.txt file, queued for the log_writer task
+async def log_event(ctx, tag, bug_id, stage):
+    ts = log_timestamp()
     line = f"[{ts}] [{tag}] Bug {bug_id} at stage: {stage}\n"
-    async with log_lock:
-        with open("pipeline_log.txt", "a", encoding="utf-8") as f:
-            f.write(line)
+    ctx.log_queue.put_nowait(line)
 
-async def read_worker():
+async def read_worker(ctx):
     '''Reads title + description from bug report folder'''
     while True:
-        bug_dir, bug_id = await read_queue.get()
-        await log_event("READ", bug_id, "start")
-        raw = readBugReportContent_agent.run(bug_dir).get("file_content", "")
-        extended_raw = raw + "\n" + load_image_content(bug_dir, bug_id)
-        await log_event("READ", bug_id, "done")
-        await process_queue.put((bug_dir, bug_id, raw, extended_raw))
-        await reason_queue.put((bug_dir, bug_id, raw, extended_raw))
-        read_queue.task_done()
-
-async def process_worker(output_base):
+        bug_dir, bug_id = await ctx.read_queue.get()
+        await log_event(ctx, "READ", bug_id, "start")
+        raw = await run_blocking(readBugReportContent_agent.run_raw, bug_dir)
+        image_text = await run_blocking(load_image_content, bug_dir, bug_id)
+        # one join instead of two concatenations, and no copy at all when the bug has no image content
+        extended_raw = "\n".join((raw, image_text)) if image_text else raw
+        await log_event(ctx, "READ", bug_id, "done")
+        await ctx.process_queue.put((bug_dir, bug_id, raw, extended_raw))
+        await ctx.reason_queue.put((bug_dir, bug_id, raw, extended_raw))
+        ctx.read_queue.task_done()
+
+async def process_worker(ctx):
     '''Processes baseline and extended content'''
     while True:
-        bug_dir, bug_id, raw, extended_raw= await process_queue.get()
-        await log_event("PROCESS", bug_id, "start")
-        processed = processBugReportContent_agent.run(raw).get("file_content", "")
-        extended_processed = processBugReportContent_agent.run(extended_raw).get("file_content", "")
-        output_dir = os.path.join(output_base, bug_id)
-        os.makedirs(output_dir, exist_ok=True)
-        with open(os.path.join(output_dir, f"{bug_id}_baseline_query.txt"), "w", encoding="utf-8") as f:
-            f.write(processed)
-        with open(os.path.join(output_dir, f"{bug_id}_extended_query.txt"), "w", encoding="utf-8") as f:
-            f.write(extended_processed)
-        await log_event("PROCESS", bug_id, "done")
-        await localization_queue.put((bug_id, processed, extended_processed, "keyBERT"))
-        await keybert_queue.put((bug_dir, bug_id, processed, extended_processed))
-        process_queue.task_done()
-
-async def keybert_worker(output_base, top_n):
-    '''Extracts keywords for both baseline and extended queries and writes them to disk'''
-    while True:
-        bug_dir, bug_id, baseline_processed, extended_processed= await keybert_queue.get()
-        await log_event("KEYBERT", bug_id, "start")
-        
-        print("In keyBERT baseline_processed: "+baseline_processed)
-        print("In keyBERT extended_processed: "+extended_processed)
-        # === Baseline ===
-        keywords = await run_blocking(processBugReportQueryKeyBERT_agent.run, baseline_processed, top_n)
-        baseline_query = " ".join(keywords.get("file_content", "")) 
-        #baseline_query = processBugReportQueryKeyBERT_agent.run(baseline_processed, top_n).get("file_content", "")
-
-        # === Extended ===
-        extended_keywords = await run_blocking(processBugReportQueryKeyBERT_agent.run, extended_processed, top_n)
-        extended_query = " ".join(extended_keywords.get("file_content", "")) 
-        #extended_query = processBugReportQueryKeyBERT_agent.run(extended_processed, top_n).get("file_content", "")
+        bug_dir, bug_id, raw, extended_raw= await ctx.process_queue.get()
+        await log_event(ctx, "PROCESS", bug_id, "start")
+        # extended_raw is raw, or raw + "\n" + image content and preprocessing never joins tokens across that newline,
+        # so only the image content is preprocessed on top of raw
+        processed, image_processed = await asyncio.gather(
+            run_in_process(ctx.process_pool, processBugReportContent, raw),
+            run_in_process(ctx.process_pool, processBugReportContent, extended_raw[len(raw):]),
+        )
+        extended_processed = " ".join(filter(None, [processed, image_processed]))
+        output_dir = os.path.join(ctx.output_base, bug_id)
+        await run_blocking(write_text_files, [(os.path.join(output_dir, f"{bug_id}_baseline_query.txt"), processed),
+                                              (os.path.join(output_dir, f"{bug_id}_extended_query.txt"), extended_processed)])
+        await log_event(ctx, "PROCESS", bug_id, "done")
+        await ctx.localization_queue.put((bug_id, processed, extended_processed, "keyBERT"))
+        await ctx.keybert_queue.put((bug_dir, bug_id, processed, extended_processed))
+        ctx.process_queue.task_done()
 
+def write_keybert_queries(output_base, bug_ids, queries):
+    '''Writes the baseline and extended KeyBERT query of each bug to its output folder'''
+    for bug_id, (baseline_query, extended_query) in zip(bug_ids, queries):
         output_dir = os.path.join(output_base, bug_id)
-        os.makedirs(output_dir, exist_ok=True)
         with open(os.path.join(output_dir, f"{bug_id}_baseline_keyBERT_query.txt"), "w", encoding="utf-8") as f:
             f.write(baseline_query)
         with open(os.path.join(output_dir, f"{bug_id}_extended_keyBERT_query.txt"), "w", encoding="utf-8") as f:
             f.write(extended_query)
 
-        await log_event("KEYBERT", bug_id, "done")
-        await localization_queue.put((bug_id, baseline_query, extended_query, "basic"))
-        keybert_queue.task_done()
+async def keybert_worker(ctx):
+    '''Extracts keywords for the baseline and extended queries of a batch of bugs and writes them to disk'''
+    while True:
+        batch = await drain_queue(ctx.keybert_queue, keybert_batch_size, keybert_batch_linger)
+
+        contents, debug_lines = [], []
+        for bug_dir, bug_id, baseline_processed, extended_processed in batch:
+            await log_event(ctx, "KEYBERT", bug_id, "start")
+            debug_lines += ["In keyBERT baseline_processed: "+baseline_processed, "In keyBERT extended_processed: "+extended_processed]
+            contents += [baseline_processed, extended_processed]
+        print("\n".join(debug_lines))
+
+        # === Baseline and extended of every bug in one KeyBERT call ===
+        keywords = await run_blocking(processBugReportQueryKeyBERT_batch_agent.run_raw, contents, ctx.top_n)
+        if isinstance(keywords, str):
+            # the agent failed, use its error message as the query
+            keywords = [[keywords]] * len(contents)
 
-async def reason_worker(output_base):
+        bug_ids = [bug_id for _, bug_id, _, _ in batch]
+        queries = [(" ".join(keywords[2 * i]), " ".join(keywords[2 * i + 1])) for i in range(len(batch))]
+        # all query files of the batch are written in one executor call instead of on the event loop
+        await run_blocking(write_keybert_queries, ctx.output_base, bug_ids, queries)
+
+        for bug_id, (baseline_query, extended_query) in zip(bug_ids, queries):
+            await log_event(ctx, "KEYBERT", bug_id, "done")
+            await ctx.localization_queue.put((bug_id, baseline_query, extended_query, "basic"))
+            ctx.keybert_queue.task_done()
+
+async def reason_worker(ctx):
     while True:
-        bug_dir, bug_id, raw, extended_raw = await reason_queue.get()
-        await log_event("REASON", bug_id, "start")
+        bug_dir, bug_id, raw, extended_raw = await ctx.reason_queue.get()
+        await log_event(ctx, "REASON", bug_id, "start")
         #=== Baseline ===
         reason_results = await run_blocking(processBugReportQueryReasoning_agent.run, raw)
         raw_results = reason_results.get("file_content")
         print("reason_raw_results: "+raw_results)
 
         # === Extended ===
-        reason_results = await run_blocking(processBugReportQueryReasoning_agent.run, extended_raw)
-        extended_results = reason_results.get("file_content")
+        # without image content the extended report is the baseline one, its LLM calls would repeat the baseline ones
+        same_report = extended_raw == raw
+        if same_report:
+            extended_results = raw_results
+        else:
+            reason_results = await run_blocking(processBugReportQueryReasoning_agent.run, extended_raw)
+            extended_results = reason_results.get("file_content")
         print("reason_extended_results: "+extended_results)
      
         # === Baseline ===
@@ -119,104 +157,119 @@ async def reason_worker(output_base):
         print("reason_processed_raw_results: "+baseline_query)
 
         # # # === Extended ===
-        processed_results = await run_blocking(processBugReportContentPostReasoning_agent.run, extended_results)
-        extended_query = processed_results.get("file_content")
+        if same_report:
+            extended_query = baseline_query
+        else:
+            processed_results = await run_blocking(processBugReportContentPostReasoning_agent.run, extended_results)
+            extended_query = processed_results.get("file_content")
         print("reason_processed_extended_results: "+extended_query)
 
-        output_dir = os.path.join(output_base, bug_id)
+        output_dir = os.path.join(ctx.output_base, bug_id)
        
-        with open(os.path.join(output_dir, f"{bug_id}_baseline_reasoning.txt"), "w", encoding="utf-8") as f:
-            f.write(raw_results)
-        with open(os.path.join(output_dir, f"{bug_id}_extended_reasoning.txt"), "w", encoding="utf-8") as f:
-            f.write(extended_results)
-        with open(os.path.join(output_dir, f"{bug_id}_baseline_reasoning_query.txt"), "w", encoding="utf-8") as f:
-            f.write(baseline_query)
-        with open(os.path.join(output_dir, f"{bug_id}_extended_reasoning_query.txt"), "w", encoding="utf-8") as f:
-            f.write(extended_query)
+        await run_blocking(write_text_files, [(os.path.join(output_dir, f"{bug_id}_baseline_reasoning.txt"), raw_results),
+                                              (os.path.join(output_dir, f"{bug_id}_extended_reasoning.txt"), extended_results),
+                                              (os.path.join(output_dir, f"{bug_id}_baseline_reasoning_query.txt"), baseline_query),
+                                              (os.path.join(output_dir, f"{bug_id}_extended_reasoning_query.txt"), extended_query)])
       
         
-        await log_event("REASON", bug_id, "done")
-        await localization_queue.put((bug_id, baseline_query, extended_query, "reasoning"))
-        reason_queue.task_done()
+        await log_event(ctx, "REASON", bug_id, "done")
+        await ctx.localization_queue.put((bug_id, baseline_query, extended_query, "reasoning"))
+        ctx.reason_queue.task_done()
+
 
+def write_text_files(files):
+    '''Writes each (path, text) pair, the bug's folder already exists'''
+    for path, text in files:
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
 
-async def localize_worker(search_base, top_n_documents, processed_documents, query_type):
-    '''Runs BM25+FAISS localization on extended queries'''
+async def localize_worker(ctx):
+    '''Runs BM25+FAISS localization on the baseline and extended queries of a batch of bugs'''
     while True:
-        bug_id, baseline_q, extended_q, query_type = await localization_queue.get()
-
-        await log_event("LOCALIZE", bug_id, "baseline "+query_type+" start")
-        baseline_search_results = await run_blocking(
-            bug_localization_BM25_and_FAISS_agent.run,
-            bug_id, baseline_q, top_n_documents,
-            bm25_index, faiss_index, processed_documents,
-            bm25_weight, faiss_weight
-        )
+        batch = await drain_queue(ctx.localization_queue, localize_batch_size)
 
-        out_dir = os.path.join(search_base, bug_id)
-        os.makedirs(out_dir, exist_ok=True)
-        with open(os.path.join(out_dir, f"{bug_id}_baseline_"+query_type+"_query_result.txt"),
-                  "w", encoding="utf-8") as f:
-            f.write(baseline_search_results.get("file_content", ""))
-        await log_event("LOCALIZE", bug_id, "baseline"+query_type+" done")
-
-        await log_event("LOCALIZE", bug_id, "extended"+query_type+" start")
-        extended_search_results = await run_blocking(
-            bug_localization_BM25_and_FAISS_agent.run,
-            bug_id, extended_q, top_n_documents,
-            bm25_index, faiss_index, processed_documents,
-            bm25_weight, faiss_weight
+        bug_ids, queries = [], []
+        for bug_id, baseline_q, extended_q, query_type in batch:
+            await log_event(ctx, "LOCALIZE", bug_id, query_type+" start")
+            bug_ids += [bug_id, bug_id]
+            queries += [baseline_q, extended_q]
+
+        # identical queries are searched once, e.g. extended == baseline when a bug has no image content
+        unique_queries = {}
+        for bug_id, query in zip(bug_ids, queries):
+            unique_queries.setdefault(query, bug_id)
+
+        search_results = await run_blocking(
+            bug_localization_BM25_and_FAISS_batch_agent.run_raw,
+            list(unique_queries.values()), list(unique_queries), ctx.top_n_documents,
+            ctx.bm25_index, ctx.faiss_index, ctx.processed_documents,
+            ctx.bm25_weight, ctx.faiss_weight
         )
-        with open(os.path.join(out_dir, f"{bug_id}_extended_"+query_type+"_query_result.txt"),
-                  "w", encoding="utf-8") as f:
-            f.write(extended_search_results.get("file_content", ""))
-        await log_event("LOCALIZE", bug_id, "extended "+query_type+" done")
-        localization_queue.task_done()
+        if isinstance(search_results, str):
+            # the agent failed, write its error message for every query
+            search_results = [search_results] * len(unique_queries)
+        results_by_query = dict(zip(unique_queries, search_results))
+        search_results = [results_by_query[query] for query in queries]
+
+        result_files = []
+        for i, (bug_id, _, _, query_type) in enumerate(batch):
+            out_dir = os.path.join(ctx.search_base, bug_id)
+            result_files += [(os.path.join(out_dir, f"{bug_id}_baseline_"+query_type+"_query_result.txt"), search_results[2 * i]),
+                             (os.path.join(out_dir, f"{bug_id}_extended_"+query_type+"_query_result.txt"), search_results[2 * i + 1])]
+        # the writes run in the executor, so the other stages keep running meanwhile
+        await run_blocking(write_text_files, result_files)
+
+        for bug_id, _, _, query_type in batch:
+            await log_event(ctx, "LOCALIZE", bug_id, query_type+" done")
+            ctx.localization_queue.task_done()
 
 async def main_async(project_id, bug_reports_root, source_code_dir, queries_output_root, search_result_path):
-    global read_queue, process_queue, keybert_queue, reason_queue, localization_queue
-    global bm25_index, faiss_index, query_type
-    read_queue         = asyncio.Queue()
-    process_queue      = asyncio.Queue()
-    keybert_queue      = asyncio.Queue()
-    reason_queue       = asyncio.Queue()
-    localization_queue = asyncio.Queue()
     # index source code and load indexes (bm25_index, faiss_index) and processed documents
     bm25_index, faiss_index, processed_documents = index_source_code_agent.run(source_code_dir).get("file_content", "[]")
-    top_n_documents = len(processed_documents) # Number of top documents to retrieve, but default is 100
+
+    ctx = PipelineCtx(
+        output_base=os.path.join(queries_output_root, project_id),
+        search_base=os.path.join(search_result_path, project_id),
+        bm25_index=bm25_index,
+        faiss_index=faiss_index,
+        processed_documents=processed_documents,
+        process_pool=ProcessPoolExecutor(max_workers=process_workers, mp_context=multiprocessing.get_context("spawn")),
+        top_n_documents=len(processed_documents), # rank every document, not just the default 100
+    )
 
     bug_path = os.path.join(bug_reports_root, project_id)
-    output_base = os.path.join(queries_output_root, project_id)
-    os.makedirs(output_base, exist_ok=True)
-    search_results_base = os.path.join(search_result_path, project_id)
-    os.makedirs(search_results_base, exist_ok=True)
+    os.makedirs(ctx.output_base, exist_ok=True)
+    os.makedirs(ctx.search_base, exist_ok=True)
     open("pipeline_log.txt", "w", encoding="utf-8").close()
     
 
-    # Fill read queue with bug IDs
-    for bug_id in os.listdir(bug_path):
-        bug_dir = os.path.join(bug_path, bug_id)
-        if os.path.isdir(bug_dir):
-            await read_queue.put((bug_dir, bug_id))
-
     # Start
     workers = [
-        asyncio.create_task(read_worker()),
-        asyncio.create_task(process_worker(output_base)),
-        asyncio.create_task(keybert_worker(output_base, top_n)),
-        asyncio.create_task(reason_worker(output_base)),
-        *[asyncio.create_task(localize_worker(search_results_base, top_n_documents, processed_documents, query_type)) for _ in range(4)],
+        *[asyncio.create_task(read_worker(ctx)) for _ in range(read_workers)],
+        *[asyncio.create_task(process_worker(ctx)) for _ in range(process_workers)],
+        asyncio.create_task(keybert_worker(ctx)),
+        asyncio.create_task(reason_worker(ctx)),
+        # one localize worker: FAISS and the BM25 kernel already use every core for a batch,
+        # concurrent batches would only oversubscribe the threads
+        asyncio.create_task(localize_worker(ctx)),
+        asyncio.create_task(log_writer(ctx.log_queue, "pipeline_log.txt")),
     ]
+    # Fill read queue with bug IDs, the workers are already running since the queue is bounded
+    # scandir entries carry their type, no extra stat per bug folder
+    with os.scandir(bug_path) as entries:
+        bug_dirs = [(entry.path, entry.name) for entry in entries if entry.is_dir()]
+    # every bug's query and result folders are created up front in one executor call, not per write
+    await run_blocking(make_bug_dirs, [ctx.output_base, ctx.search_base], [bug_id for _, bug_id in bug_dirs])
+    for bug_dir, bug_id in bug_dirs:
+        await ctx.read_queue.put((bug_dir, bug_id))
+
     # Wait for all queues to finish
-    await read_queue.join()
-    await process_queue.join()
-    await keybert_queue.join()
-    await reason_queue.join()
-    await localization_queue.join()
+    await join_queues([ctx.read_queue, ctx.process_queue, ctx.keybert_queue, ctx.reason_queue, ctx.localization_queue, ctx.log_queue], workers)
 
     # Finish
     for w in workers:
         w.cancel()
+    ctx.process_pool.shutdown()
 
 
 if __name__ == "__main__":
@@ -21,10 +21,9 @@ def get_available_projects():
     root = os.path.abspath("AgentProjectData/ProjectBugReports")
     if not os.path.exists(root):
         return []
-    return sorted(
-        d for d in os.listdir(root)
-        if os.path.isdir(os.path.join(root, d))
-    )
+    # scandir entries carry their type, no extra stat per project folder
+    with os.scandir(root) as entries:
+        return sorted(entry.name for entry in entries if entry.is_dir())
 
 
 async def process_selected_projects(selected_projects):
@@ -36,8 +35,8 @@ async def process_selected_projects(selected_projects):
         project_source_dir = os.path.join(SOURCE_CODES_ROOT, f"Project{project_id}")
         
         if os.path.exists(project_source_dir):
-            subdirs = [d for d in os.listdir(project_source_dir) 
-                       if os.path.isdir(os.path.join(project_source_dir, d)) and d != "Corpus"]
+            with os.scandir(project_source_dir) as entries:
+                subdirs = [entry.name for entry in entries if entry.is_dir() and entry.name != "Corpus"]
             source_code_dir = os.path.join(project_source_dir, subdirs[0]) if subdirs else project_source_dir
             src_dir = os.path.join(source_code_dir, "src")
             if os.path.exists(src_dir):
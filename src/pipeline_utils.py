@@ -0,0 +1,79 @@
+# Helpers shared by the asyncio pipelines (main, KEYBERT, NLP, reason, reasonfull)
+
+import os
+import asyncio, time
+
+log_max_bytes = 64 << 20 # Size at which a log file is rotated
+
+
+# Helper : run CPU-bound Python code (text preprocessing) in the process pool to bypass the GIL.
+# The pools are spawned, a forked worker would inherit the loaded models and the locks held by the other threads.
+# fn comes from text_preprocessing, not from an agent, so the workers never load a model.
+# Like Agent.run_raw, a failure is returned as the "Error: ..." message
+async def run_in_process(pool, fn, *args):
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(pool, fn, *args)
+    except Exception as e:
+        return f"Error: {e}"
+
+# Helper: wait until every queue is drained, re-raising the error of a worker that dies meanwhile instead of hanging
+async def join_queues(queues, workers):
+    async def join_all():
+        for queue in queues:
+            await queue.join()
+    joined = asyncio.ensure_future(join_all())
+    done, _ = await asyncio.wait([joined, *workers], return_when=asyncio.FIRST_COMPLETED)
+    if joined not in done:
+        joined.cancel()
+        for w in workers:
+            w.cancel()
+        for w in done:
+            w.result()
+
+# Helper: wait for one item, give the batch up to linger seconds to fill, then take whatever else is queued (up to max_items)
+async def drain_queue(queue, max_items, linger=0):
+    batch = [await queue.get()]
+    if linger and queue.qsize() < max_items - 1:
+        await asyncio.sleep(linger)
+    while len(batch) < max_items and not queue.empty():
+        batch.append(queue.get_nowait())
+    return batch
+
+# Helper: "%H:%M:%S" of the current second, formatted only when the second changes
+_last_ts_epoch, _last_ts_str = None, ""
+def log_timestamp():
+    global _last_ts_epoch, _last_ts_str
+    now = int(time.time())
+    if now != _last_ts_epoch:
+        _last_ts_epoch, _last_ts_str = now, time.strftime("%H:%M:%S", time.localtime(now))
+    return _last_ts_str
+
+def rotate_log(log_path):
+    '''Keeps the full log as <log_path>.1, replacing the previous one, so the next writes start a new file'''
+    try:
+        os.replace(log_path, log_path + ".1")
+    except FileNotFoundError:
+        pass
+
+async def log_writer(log_queue, log_path):
+    '''Only task writing the log: keeps the file open and writes whatever lines are queued in one call.
+    There must be one writer per log file, a process writing to a file another one rotated loses its lines'''
+    while True:
+        with open(log_path, "a", encoding="utf-8", buffering=1 << 16) as f:
+            size = f.tell()
+            while size < log_max_bytes:
+                lines = await drain_queue(log_queue, 256)
+                f.writelines(lines)
+                size += sum(len(line.encode("utf-8")) for line in lines)  # bytes, not characters: bug text is not always ASCII
+                if log_queue.empty():
+                    f.flush()
+                for _ in lines:
+                    log_queue.task_done()
+        rotate_log(log_path)
+
+def make_bug_dirs(bases, bug_ids):
+    '''Creates the output folder of every bug under each base folder'''
+    for base in bases:
+        for bug_id in bug_ids:
+            os.makedirs(os.path.join(base, bug_id), exist_ok=True)
@@ -1,25 +1,35 @@
 import os
+import re
+
+_IMAGE_NUMBER_RE = re.compile(r"\d+")
 
 
 def read_file_with_fallback(path):
     """Reads the file with fallback encoding, helper function for the loading of image content"""
+    # read the bytes once and only redo the decoding when the file is not UTF-8
+    with open(path, "rb") as f:
+        data = f.read()
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            return f.read().strip()
+        text = data.decode("utf-8")
     except UnicodeDecodeError:
-        with open(path, "r", encoding="iso-8859-1") as f:
-            return f.read().strip()
+        text = data.decode("iso-8859-1")
+    # same newline translation as reading in text mode
+    return text.replace("\r\n", "\n").replace("\r", "\n").strip()
+
+def image_file_order(bug_id, name):
+    """Sort key of an image content file: the number between the bug id and ImageContent.txt, so image 10 comes after image 2"""
+    match = _IMAGE_NUMBER_RE.search(name, len(bug_id), len(name) - len("ImageContent.txt"))
+    return (int(match.group()) if match else -1, name)
         
 def load_image_content(bug_dir, bug_id):
     """Loads all image content files for a given bug report, helper function for the extended query"""
-    content = ""
-    image_files = sorted([
-        f for f in os.listdir(bug_dir)
-        if f.startswith(bug_id) and f.endswith("ImageContent.txt")
-    ])
-    for image_file in image_files:
-        image_path = os.path.join(bug_dir, image_file)
-        content += "\n" + read_file_with_fallback(image_path)
-    return content.strip()
+    with os.scandir(bug_dir) as entries:
+        image_files = [
+            (image_file_order(bug_id, entry.name), entry.path) for entry in entries
+            if entry.name.startswith(bug_id) and entry.name.endswith("ImageContent.txt") and entry.is_file()
+        ]
+    image_files.sort()
+    contents = [read_file_with_fallback(image_path) for _, image_path in image_files]
+    return "\n".join(contents).strip()
 
 
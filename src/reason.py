@@ -1,6 +1,7 @@
 import os
-import asyncio, functools, time
+import asyncio, functools
 from query_constructions import load_image_content
+from pipeline_utils import log_timestamp, log_writer
 from agents import (
     readBugReportContent_agent,
     processBugReportQueryReasoning_agent,
@@ -11,31 +12,37 @@ from agents import (
 )
 import sys
 
-read_queue = reason_queue = process_queue = reflect_queue = localization_queue = None
+read_queue = reason_queue = process_queue = reflect_queue = localization_queue = log_queue = None
 bm25_index = faiss_index = None
 bm25_weight = 0.5
 faiss_weight = 0.5
 top_n_documents = 100
+read_workers = 8 # Number of bug folders read concurrently
 
 async def run_blocking(fn, *args, **kw):
     loop = asyncio.get_running_loop()
     part = functools.partial(fn, *args, **kw)
     return await loop.run_in_executor(None, part)
 
-log_lock = asyncio.Lock()
+# Helper : write a text file, called through run_blocking so the event loop keeps running
+def write_text(path, content):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(content)
+
+# Helper: queue a log line for the log_writer task
 async def log_event(tag, bug_id, stage, project_id):
-    ts = time.strftime("%H:%M:%S", time.localtime())
+    ts = log_timestamp()
     line = f"[{ts}] [{tag}] Project {project_id} Bug {bug_id} at stage: {stage}\n"
-    async with log_lock:
-        with open("./logs/parallel_logs/reason_log.txt", "a", encoding="utf-8") as f:
-            f.write(line)
+    log_queue.put_nowait(line)
 
 async def read_worker(project_id):
     while True:
         bug_dir, bug_id = await read_queue.get()
         await log_event("READ", bug_id, "start", project_id)
-        raw = readBugReportContent_agent.run(bug_dir).get("file_content", "")
-        extended_raw = raw + "\n" + load_image_content(bug_dir, bug_id)
+        raw = (await run_blocking(readBugReportContent_agent.run, bug_dir)).get("file_content", "")
+        image_text = await run_blocking(load_image_content, bug_dir, bug_id)
+        # one join instead of two concatenations, and no copy at all when the bug has no image content
+        extended_raw = "\n".join((raw, image_text)) if image_text else raw
         await reason_queue.put((bug_dir, bug_id, raw, extended_raw))
         await log_event("READ", bug_id, "done", project_id)
         read_queue.task_done()
@@ -44,8 +51,16 @@ async def reason_worker(project_id):
     while True:
         bug_dir, bug_id, raw, extended_raw = await reason_queue.get()
         await log_event("REASON", bug_id, "start", project_id)
-        reasoned_raw = processBugReportQueryReasoning_agent.run(raw).get("file_content", "")
-        reasoned_extended = processBugReportQueryReasoning_agent.run(extended_raw).get("file_content", "")
+        if extended_raw == raw:
+            # no image content, the extended report is the baseline one and needs no second LLM call
+            reasoned_raw = (await run_blocking(processBugReportQueryReasoning_agent.run, raw)).get("file_content", "")
+            reasoned_extended = reasoned_raw
+        else:
+            # both LLM calls run in the executor at once, the event loop keeps serving the other workers
+            reasoned_raw, reasoned_extended = [result.get("file_content", "") for result in await asyncio.gather(
+                run_blocking(processBugReportQueryReasoning_agent.run, raw),
+                run_blocking(processBugReportQueryReasoning_agent.run, extended_raw),
+            )]
         await process_queue.put((bug_dir, bug_id, raw, extended_raw, reasoned_raw, reasoned_extended))
         await log_event("REASON", bug_id, "done", project_id)
         reason_queue.task_done()
@@ -54,8 +69,14 @@ async def process_worker(output_base, project_id):
     while True:
         bug_dir, bug_id, raw, extended_raw, raw_reasoned, ext_reasoned = await process_queue.get()
         await log_event("PROCESS", bug_id, "start", project_id)
-        baseline_query = processBugReportContentPostReasoning_agent.run(raw_reasoned).get("file_content", "")
-        extended_query = processBugReportContentPostReasoning_agent.run(ext_reasoned).get("file_content", "")
+        if ext_reasoned == raw_reasoned:
+            baseline_query = (await run_blocking(processBugReportContentPostReasoning_agent.run, raw_reasoned)).get("file_content", "")
+            extended_query = baseline_query
+        else:
+            baseline_query, extended_query = [result.get("file_content", "") for result in await asyncio.gather(
+                run_blocking(processBugReportContentPostReasoning_agent.run, raw_reasoned),
+                run_blocking(processBugReportContentPostReasoning_agent.run, ext_reasoned),
+            )]
         
         # Do not delete the following lines
         # with open(os.path.join(out_dir, f"{bug_id}_baseline_reasoning_query_raw.txt"), "w", encoding="utf-8") as f:
@@ -65,8 +86,7 @@ async def process_worker(output_base, project_id):
 
         # with open(os.path.join(output_base, f"{bug_id}_baseline_reasoning_query.txt"), "w", encoding="utf-8") as f:
         #     f.write(baseline_query)
-        with open(os.path.join(output_base, f"{bug_id}_extended_reasoning_query.txt"), "w", encoding="utf-8") as f:
-            f.write(extended_query)
+        await run_blocking(write_text, os.path.join(output_base, f"{bug_id}_extended_reasoning_query.txt"), extended_query)
 
         await log_event("PROCESS", bug_id, "done", project_id)
         await reflect_queue.put((bug_dir, bug_id, raw, extended_raw, raw_reasoned, ext_reasoned))
@@ -77,8 +97,10 @@ async def reflect_worker(output_base, project_id):
     while True:
         bug_dir, bug_id, raw, extended_raw, raw_reasoned, ext_reasoned = await reflect_queue.get()
         await log_event("REFLECT", bug_id, "start", project_id)
-        baseline_reflect_result = processBugReportQueryReasoningReflectOnResults_agent.run(raw, raw_reasoned).get("file_content", "")
-        extended_reflect_result = processBugReportQueryReasoningReflectOnResults_agent.run(extended_raw, ext_reasoned).get("file_content", "")
+        baseline_reflect_result, extended_reflect_result = [result.get("file_content", "") for result in await asyncio.gather(
+            run_blocking(processBugReportQueryReasoningReflectOnResults_agent.run, raw, raw_reasoned),
+            run_blocking(processBugReportQueryReasoningReflectOnResults_agent.run, extended_raw, ext_reasoned),
+        )]
 
         #Do not delete the following 4 lines. They are for testing whether reflect function is working or not.
         # with open(os.path.join(output_base, f"{bug_id}_baseline_reasoning_reflect_query.txt"), "w", encoding="utf-8") as f:
@@ -109,10 +131,9 @@ async def reflect_worker(output_base, project_id):
             # The seatch query is not good enough and need to create anothe search query using reasoning agent.
             print("modified search query"+ extended_reflect_result.strip().lower())
             #sys.stdout.flush()
-            extended_modified_query = processBugReportContentPostReasoning_agent.run(extended_reflect_result.strip().lower()).get("file_content", "")
+            extended_modified_query = (await run_blocking(processBugReportContentPostReasoning_agent.run, extended_reflect_result.strip().lower())).get("file_content", "")
             print(extended_modified_query)
-            with open(os.path.join(output_base, f"{bug_id}_extended_reasoning_query.txt"), "w", encoding="utf-8") as f:
-                f.write(extended_modified_query)
+            await run_blocking(write_text, os.path.join(output_base, f"{bug_id}_extended_reasoning_query.txt"), extended_modified_query)
     
 
         await log_event("REFLECT", bug_id, "done", project_id)
@@ -150,7 +171,7 @@ async def localize_worker(search_base, top_n_documents, processed_documents, pro
         localization_queue.task_done()
 
 async def main_async(project_id, bug_reports_root, queries_output_root, search_result_path, source_code_dir, bm25_faiss_dir):
-    global read_queue, reason_queue, process_queue, reflect_queue, localization_queue
+    global read_queue, reason_queue, process_queue, reflect_queue, localization_queue, log_queue
     global bm25_index, faiss_index
 
     read_queue         = asyncio.Queue()
@@ -158,6 +179,7 @@ async def main_async(project_id, bug_reports_root, queries_output_root, search_r
     process_queue      = asyncio.Queue()
     reflect_queue      = asyncio.Queue()
     localization_queue = asyncio.Queue()
+    log_queue          = asyncio.Queue()
 
     # Do not delete. We will use this later
     #bm25_index, faiss_index, processed_documents = index_source_code_agent.run(source_code_dir, f"project{project_id}", bm25_faiss_dir).get("file_content", "")
@@ -170,13 +192,15 @@ async def main_async(project_id, bug_reports_root, queries_output_root, search_r
     os.makedirs(search_base, exist_ok=True)
     os.makedirs("./logs/parallel_logs", exist_ok=True)
 
-    for bug_id in os.listdir(bug_path):
-        bug_dir = os.path.join(bug_path, bug_id)
-        if os.path.isdir(bug_dir):
-            await read_queue.put((bug_dir, bug_id))
+    # scandir entries carry their type, no extra stat per bug folder
+    with os.scandir(bug_path) as entries:
+        bug_dirs = [(entry.path, entry.name) for entry in entries if entry.is_dir()]
+    for bug_dir, bug_id in bug_dirs:
+        await read_queue.put((bug_dir, bug_id))
 
     workers = [
-        asyncio.create_task(read_worker(project_id)),
+        asyncio.create_task(log_writer(log_queue, "./logs/parallel_logs/reason_log.txt")),
+        *[asyncio.create_task(read_worker(project_id)) for _ in range(read_workers)],
         asyncio.create_task(reason_worker(project_id)),
         asyncio.create_task(process_worker(output_base, project_id)),
         asyncio.create_task(reflect_worker(output_base, project_id)),
@@ -189,6 +213,7 @@ async def main_async(project_id, bug_reports_root, queries_output_root, search_r
     await process_queue.join()
     await reflect_queue.join()
     await localization_queue.join()
+    await log_queue.join()
 
     for w in workers:
         w.cancel()
@@ -225,8 +250,8 @@ if __name__ == "__main__":
             
             # Find the actual source directory (exclude Corpus directory)
             if os.path.exists(project_source_dir):
-                subdirs = [d for d in os.listdir(project_source_dir) 
-                          if os.path.isdir(os.path.join(project_source_dir, d)) and d != "Corpus"]
+                with os.scandir(project_source_dir) as entries:
+                    subdirs = [entry.name for entry in entries if entry.is_dir() and entry.name != "Corpus"]
                 if subdirs:
                     # Take the first non-Corpus subdirectory as the source directory
                     source_code_dir = os.path.join(project_source_dir, subdirs[0])
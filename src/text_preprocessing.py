@@ -0,0 +1,87 @@
+# Bug report text preprocessing.
+# Kept apart from tools.py so the process pool workers running it only import regex, not the models and indexes
+
+import functools
+import regex
+
+STOPWORDS_PATH = "./stop_words_english.txt"
+
+# read the stopwords (once per path)
+@functools.lru_cache(maxsize=None)
+def load_stopwords(file_path: str) -> frozenset[str]:
+    with open(file_path, 'r', encoding='utf-8') as file:
+        return frozenset(word.strip() for word in file if word.strip())
+
+# patterns used by preprocess_text, compiled once
+_MARKDOWN_IMAGE_RE = regex.compile(r'\!\[.*?\]\(https?://\S+?\)')
+_URL_RE = regex.compile(r'https?://\S+|www\.\S+')
+_CAMEL_RE = regex.compile(r'([a-z0-9])([A-Z])')
+_ACRONYM_RE = regex.compile(r'([A-Z]+)([A-Z][a-z])')
+# runs of letters, i.e. what is left after removing whitespace, punctuation and numbers
+_WORD_RE = regex.compile(r'[^\W\d]+')
+
+def preprocess_text(bug_report_content:str) -> str:
+   
+    stopwords = load_stopwords(STOPWORDS_PATH)
+   
+    # remove urls and the markdown link
+    bug_report_content = _MARKDOWN_IMAGE_RE.sub('', bug_report_content)
+    bug_report_content = _URL_RE.sub('', bug_report_content)
+    
+    # split camelCase and snake_case while keeping acronyms
+    bug_report_content = _CAMEL_RE.sub(r'\1 \2', bug_report_content)
+    bug_report_content = _ACRONYM_RE.sub(r'\1 \2', bug_report_content)
+    bug_report_content = bug_report_content.replace('_', ' ')
+    
+    words = []
+    for word in bug_report_content.lower().split():
+        # remove stopwords
+        if word in stopwords:
+            continue
+        # remove punctuation and numbers, then stopwords again to catch any that were connected to punctuation
+        # and words with fewer than 3 characters
+        words.extend(part for part in _WORD_RE.findall(word) if len(part) >= 3 and part not in stopwords)
+    
+    return ' '.join(words)
+
+def processBugReportContent(bug_report_content: str) -> str:
+    """Processes the content of a bug report and returns it as a string.
+
+    Args:
+        bug_report_path (str): The path to the bug report folder.
+
+    Returns:
+        str: The processed content of the bug report.
+    """
+    # Read the content of the bug report
+    query=preprocess_text(bug_report_content)
+    #print(query)
+    return query 
+
+def processBugReportContent_batch(bug_report_contents: list[str]) -> list[str]:
+    """Processes the contents of several bug reports in one call, e.g. one process pool task per batch.
+
+    Args:
+        bug_report_contents (list[str]): The contents to process.
+
+    Returns:
+        list[str]: The processed content of each bug report.
+    """
+    return [preprocess_text(content) for content in bug_report_contents]
+
+def processBugReportContentPostReasoning(bug_report_reasoning_content: str) -> str:
+    """Processes the content of a bug report and returns it as a string.
+
+    Args:
+        bug_report_reasoning_content (str): The content to process.
+
+    Returns:
+        str: The processed content of the bug report.
+    """
+    print("Processing content with post reasoning..."+str(bug_report_reasoning_content))
+    cleaned = bug_report_reasoning_content.replace("Main issue:", "").replace("Functionality:", "").replace("Summary:", "").strip()
+
+    # Read the content of the bug report
+    query=preprocess_text(cleaned)
+    #print(query)
+    return query
@@ -1,14 +1,25 @@
 # Define tools
 
 import os
-import regex
+import json
+import importlib.util
+import tempfile
+import shutil
+import functools
+import hashlib
 import pickle
+import uuid
+import zipfile
+import collections
 import openai
 import litellm
 import numpy as np
+import faiss
+import torch
 from pathlib import Path
 from sentence_transformers import SentenceTransformer
 from keybert import KeyBERT
+from sklearn.feature_extraction.text import CountVectorizer
 from langchain.document_loaders import DirectoryLoader, TextLoader
 from rank_bm25 import BM25Okapi
 from langchain.schema import Document
@@ -16,8 +27,38 @@ from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.vectorstores import FAISS
 from langchain.embeddings import HuggingFaceEmbeddings
 import sys
-import io
 import ollama
+from text_preprocessing import (
+    load_stopwords, preprocess_text, processBugReportContent, processBugReportContent_batch,
+    processBugReportContentPostReasoning
+)
+
+try:
+    from numba import njit, prange
+except ImportError:  # numba is optional, BM25Okapi.get_scores is used without it
+    njit = None
+    prange = range
+
+# The LLM responses printed by the reasoning tools are not always ASCII. The encoding is set once per process:
+# rewrapping sys.stdout on every call breaks the prints of the other threads running agents at the same time
+if hasattr(sys.stdout, "reconfigure"):
+    sys.stdout.reconfigure(encoding="utf-8")
+
+# ONNX Runtime runs the CPU forward pass of the embedding models faster than PyTorch.
+# It is optional: SentenceTransformer(backend="onnx") needs optimum and onnxruntime installed
+ONNX_BACKEND = all(importlib.util.find_spec(name) is not None for name in ("optimum", "onnxruntime"))
+
+def embedding_backend_kwargs() -> dict:
+    '''SentenceTransformer kwargs selecting the ONNX backend on CPU, empty on GPU or without onnxruntime'''
+    if ONNX_BACKEND and not torch.cuda.is_available():
+        return {"backend": "onnx"}
+    return {}
+
+def embedding_backend_tag() -> str:
+    '''Names the forward pass of the embedding models: fp16 on GPU, ONNX or PyTorch on CPU. Their embeddings differ slightly'''
+    if torch.cuda.is_available():
+        return "torch-fp16"
+    return embedding_backend_kwargs().get("backend", "torch")
 
 def readFile(folder_path: str) -> str:
     """Reads title.txt + description.txt """
@@ -31,98 +72,168 @@ def readFile(folder_path: str) -> str:
 
     return "\n".join(contents).strip()
 
-# read the stopwords
-def load_stopwords(file_path: str) -> list[str]:
-    with open(file_path, 'r', encoding='utf-8') as file:
-        return set(word.strip() for word in file if word.strip())
-    
-def preprocess_text(bug_report_content:str) -> str:
-   
-    stopwords = load_stopwords("./stop_words_english.txt")
-   
-    # remove urls and the markdown link
-    bug_report_content = regex.sub(r'\!\[.*?\]\(https?://\S+?\)', '', bug_report_content)
-    bug_report_content = regex.sub(r'https?://\S+|www\.\S+', '', bug_report_content)
-    
-    # split camelCase and snake_case while keeping acronyms
-    bug_report_content = regex.sub(r'([a-z0-9])([A-Z])', r'\1 \2', bug_report_content)
-    bug_report_content = regex.sub(r'([A-Z]+)([A-Z][a-z])', r'\1 \2', bug_report_content)
-    bug_report_content = bug_report_content.replace('_', ' ')
-    
-    # convert to lowercase and split for list comprehensions
-    words = bug_report_content.lower().split()
-    
-    # remove stopwords 
-    words = [word for word in words if word not in stopwords]
-    
-    # remove whitespace, punctuation, numbers
-    text = ' '.join(words)
-    text = regex.sub(r"[\s]+|[^\w\s]|[\d]+", " ", text)
-    words = text.split()
-    
-    # remove stopwords again to catch any that were connected to punctuation
-    words = [word for word in words if word not in stopwords]
-    
-    # remove words with fewer than 3 characters
-    words = [word for word in words if len(word) >= 3]
-    
-    return ' '.join(words)
+# KeyBERT document and candidate word embeddings, keyed by a hash of the model and of their text.
+# On disk each model has its own folder of shards, one per batch that had embeddings to compute
+KEYBERT_MODEL_NAME = "all-MiniLM-L6-v2"
+KEYBERT_CACHE_DIR = "./.cache/keybert_embeddings"
+KEYBERT_CACHE_MAX_ITEMS = 100_000 # Embeddings kept in memory, the least recently used are dropped first
+_embedding_cache = collections.OrderedDict()
+_embedding_shard_index = {}
+
+def embedding_shard_dir(model_tag: str) -> str:
+    """Folder of the embedding shards of one model and backend."""
+    return os.path.join(KEYBERT_CACHE_DIR, hashlib.blake2b(model_tag.encode("utf-8"), digest_size=8).hexdigest())
+
+def load_embedding_shard_index(model_tag: str) -> dict:
+    """Maps the key of every embedding stored for model_tag to its (shard path, row).
+    Only the keys of the shards are read, once per process and model."""
+    if model_tag in _embedding_shard_index:
+        return _embedding_shard_index[model_tag]
+    index = {}
+    try:
+        with os.scandir(embedding_shard_dir(model_tag)) as entries:
+            shard_paths = [entry.path for entry in entries if entry.name.endswith(".npz")]
+    except FileNotFoundError:
+        shard_paths = []
+    for shard_path in shard_paths:
+        try:
+            with np.load(shard_path) as shard:
+                keys = shard["keys"].tolist()
+        except (OSError, ValueError, EOFError, KeyError, zipfile.BadZipFile):  # unreadable shard: its embeddings are computed again
+            continue
+        for row, key in enumerate(keys):
+            index.setdefault(key, (shard_path, row))
+    _embedding_shard_index[model_tag] = index
+    return index
+
+def save_embedding_shard(model_tag: str, keys: list[str], embeddings: np.ndarray) -> str:
+    """Writes keys and their embeddings as a new shard through a temporary file, so a process reading the cache never sees a partial shard."""
+    shard_dir = embedding_shard_dir(model_tag)
+    os.makedirs(shard_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=shard_dir, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, keys=np.array(keys), embeddings=embeddings)
+        shard_path = os.path.join(shard_dir, uuid.uuid4().hex + ".npz")
+        os.replace(tmp_path, shard_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return shard_path
+
+def cached_embeddings(sentence_model: SentenceTransformer, model_tag: str, texts: list[str]) -> np.ndarray:
+    """Embeds texts, reusing embeddings cached in memory and on disk (as float16) by model and content hash."""
+    keys = [hashlib.blake2b(f"{model_tag}\0{text}".encode("utf-8"), digest_size=16).hexdigest() for text in texts]
+    found, missing = {}, {}
+    for key, text in zip(keys, texts):
+        if key in found or key in missing:
+            continue
+        if key in _embedding_cache:
+            _embedding_cache.move_to_end(key)
+            found[key] = _embedding_cache[key]
+        else:
+            missing[key] = text
+
+    if missing:
+        # stored by an earlier batch or run: each shard holding some of them is read once
+        index = load_embedding_shard_index(model_tag)
+        rows_by_shard = {}
+        for key in missing:
+            if key in index:
+                shard_path, row = index[key]
+                rows_by_shard.setdefault(shard_path, []).append((key, row))
+        for shard_path, key_rows in rows_by_shard.items():
+            try:
+                with np.load(shard_path) as shard:
+                    # only the needed rows are copied out, the rest of the shard is freed
+                    shard_embeddings = shard["embeddings"][[row for _, row in key_rows]]
+            except (OSError, ValueError, EOFError, KeyError, IndexError, zipfile.BadZipFile):  # removed or unreadable: embed them again
+                continue
+            for (key, _), embedding in zip(key_rows, shard_embeddings):
+                found[key] = embedding
+                del missing[key]
+
+    if missing:
+        embeddings = sentence_model.encode(list(missing.values())).astype(np.float16)
+        shard_path = save_embedding_shard(model_tag, list(missing), embeddings)
+        for row, (key, embedding) in enumerate(zip(missing, embeddings)):
+            index[key] = (shard_path, row)
+            found[key] = embedding
+
+    for key, embedding in found.items():
+        _embedding_cache[key] = embedding
+    while len(_embedding_cache) > KEYBERT_CACHE_MAX_ITEMS:
+        _embedding_cache.popitem(last=False)
+
+    return np.array([found[key] for key in keys], dtype=np.float32)
+
+def keybert_model_tag() -> str:
+    """Names the KeyBERT sentence model and its backend, without loading it."""
+    return f"{KEYBERT_MODEL_NAME}/{embedding_backend_tag()}"
+
+# loaded on first use and shared by every KeyBERT call in the process
+@functools.lru_cache(maxsize=1)
+def load_keybert_model() -> tuple[SentenceTransformer, KeyBERT, str]:
+    """Returns the sentence model, the KeyBERT model using it and a tag naming the model and its backend.
+    The fp16, ONNX and PyTorch forward passes give slightly different embeddings, the tag keeps their caches apart."""
+    sentence_model = SentenceTransformer(KEYBERT_MODEL_NAME, **embedding_backend_kwargs())
+    if sentence_model.device.type == "cuda":
+        sentence_model.half()  # fp16 forward pass, the embeddings are cached as float16 anyway
+    sentence_model.encode("warmup")  # first forward pass pays for CUDA context and kernel selection
+    return sentence_model, KeyBERT(model=sentence_model), keybert_model_tag()
 
-def processBugReportContent(bug_report_content: str) -> str:
-    """Processes the content of a bug report and returns it as a string.
+def processBugReportQueryKeyBERT(process_content: str, top_n: int) -> str:
+    """Processes the content of a bug report using KeyBERT and returns it as a string.
 
     Args:
-        bug_report_path (str): The path to the bug report folder.
+        process_content (str): The content to process.
+        top_n (int): The number of keywords to extract.
 
     Returns:
-        str: The processed content of the bug report.
+        str: The processed content.
     """
-    # Read the content of the bug report
-    query=preprocess_text(bug_report_content)
-    #print(query)
-    return query 
+    print("Processing content with KeyBERT..."+str(process_content))
+    return processBugReportQueryKeyBERT_batch([process_content], top_n)[0]
 
-def processBugReportContentPostReasoning(bug_report_reasoning_content: str) -> str:
-    """Processes the content of a bug report and returns it as a string.
+def processBugReportQueryKeyBERT_batch(process_contents: list[str], top_n: int) -> list[list[str]]:
+    """Processes the contents of several bug reports using KeyBERT, encoding all of them in one batch.
 
     Args:
-        bug_report_reasoning_content (str): The content to process.
+        process_contents (list[str]): The contents to process.
+        top_n (int): The number of keywords to extract from each content.
 
     Returns:
-        str: The processed content of the bug report.
+        list[list[str]]: The keywords extracted from each content.
     """
-    print("Processing content with post reasoning..."+str(bug_report_reasoning_content))
-    cleaned = bug_report_reasoning_content.replace("Main issue:", "").replace("Functionality:", "").replace("Summary:", "").strip()
+    print(f"Processing {len(process_contents)} contents with KeyBERT...")
+    sentence_model, kw_model, model_tag = load_keybert_model()
 
-    # Read the content of the bug report
-    query=preprocess_text(cleaned)
-    #print(query)
-    return query     
+    # one vocabulary for the whole batch: a document's candidate words are the non-zero entries of its row,
+    # the same words KeyBERT gets by fitting the document alone
+    try:
+        vectorizer = CountVectorizer(ngram_range=(1, 1), stop_words='english').fit(process_contents)
+    except ValueError:  # empty vocabulary, KeyBERT returns no keywords either
+        return [[] for _ in process_contents]
+    vocabulary = list(vectorizer.get_feature_names_out())
 
-def processBugReportQueryKeyBERT(process_content: str, top_n: int) -> str:
-    """Processes the content of a bug report using KeyBERT and returns it as a string.
+    # one encode call for all documents and one for their vocabulary
+    doc_embeddings = cached_embeddings(sentence_model, model_tag, process_contents)
+    word_embeddings = cached_embeddings(sentence_model, model_tag, vocabulary)
 
-    Args:
-        process_content (str): The content to process.
-        top_n (int): The number of keywords to extract.
-
-    Returns:
-        str: The processed content.
-    """
-    print("Processing content with KeyBERT..."+str(process_content))
-    sentence_model = SentenceTransformer("all-MiniLM-L6-v2")
-    kw_model = KeyBERT(model=sentence_model)
-    keywords_query = kw_model.extract_keywords(process_content, keyphrase_ngram_range=(1, 1), stop_words='english', use_maxsum=True, top_n=top_n)
-    keywords_query = [word for word, _ in keywords_query]
-    keywords_query = [word for word in keywords_query if len(word) >= 3]
+    # the vocabulary is passed as candidates, KeyBERT's CountVectorizer then keeps its words and order,
+    # which is the order of word_embeddings
+    all_keywords = kw_model.extract_keywords(process_contents, candidates=vocabulary, keyphrase_ngram_range=(1, 1),
+                                             stop_words='english', use_maxsum=True, top_n=top_n,
+                                             doc_embeddings=doc_embeddings, word_embeddings=word_embeddings)
+    if len(process_contents) == 1:
+        all_keywords = [all_keywords]  # KeyBERT unwraps the result of a single document
+    keywords = [[word for word, _ in keywords_query if len(word) >= 3] for keywords_query in all_keywords]
 
-    print("Keywords extracted: ", keywords_query)   
+    print("Keywords extracted: ", keywords)
 
-    return keywords_query
+    return keywords
 
 def processBugReportQueryReasoning(bug_report_content: str) -> str:
-    sys.stdout = io.TextIOWrapper(sys.stdout.detach(), encoding='utf-8')
-
     """
     Use an LLM to analyze and summarize a bug report,
     including the functionality that triggers the bug.
@@ -172,8 +283,6 @@ def processBugReportQueryReasoning(bug_report_content: str) -> str:
 
 
 def processBugReportQueryReasoningReflectOnResults(bug_report_content: str, search_query: str) -> str:
-    sys.stdout = io.TextIOWrapper(sys.stdout.detach(), encoding='utf-8')
-
     """
     Analyze a bug report and a corresponding search query.
     If the query is appropriate for localizing the bug, return "appropriate".
@@ -237,13 +346,305 @@ def processBugReportQueryReasoningReflectOnResults(bug_report_content: str, sear
 
 
 
-def index_source_code(source_code_dir: str, project_name: str = None, bm25_faiss_dir: str = None) -> str:
+def _bm25_postings_scores_jit(query_indptr, query_ids, term_indptr, posting_docs, posting_scores, n_docs):
+    """Okapi BM25 scores of several queries (CSR, one row per query) against every document, one row per query.
+    Each query term adds its precomputed posting scores, only the documents containing the term are touched."""
+    n_queries = query_indptr.shape[0] - 1
+    scores = np.zeros((n_queries, n_docs), dtype=np.float64)
+    for q in prange(n_queries):
+        for j in range(query_indptr[q], query_indptr[q + 1]):
+            term_id = query_ids[j]
+            for p in range(term_indptr[term_id], term_indptr[term_id + 1]):
+                scores[q, posting_docs[p]] += posting_scores[p]
+    return scores
+
+if njit is not None:
+    _bm25_postings_scores_jit = njit(parallel=True, cache=True)(_bm25_postings_scores_jit)
+
+def _combined_scores_jit(bm25_scores, row_distances, document_rows, bm25_weight, faiss_weight):
+    """Min-max normalizes BM25 scores and FAISS distances and mixes them, without temporary arrays."""
+    n_docs = bm25_scores.shape[0]
+    bm25_min, bm25_max = np.inf, -np.inf
+    faiss_min, faiss_max = np.inf, -np.inf
+    for d in range(n_docs):
+        bm25_min = min(bm25_min, bm25_scores[d])
+        bm25_max = max(bm25_max, bm25_scores[d])
+        distance = row_distances[document_rows[d]]
+        faiss_min = min(faiss_min, distance)
+        faiss_max = max(faiss_max, distance)
+    combined = np.empty(n_docs, dtype=np.float64)
+    for d in range(n_docs):
+        bm25_norm = (bm25_scores[d] - bm25_min) / ((bm25_max - bm25_min) + 1e-8)
+        faiss_norm = 1 - ((row_distances[document_rows[d]] - faiss_min) / ((faiss_max - faiss_min) + 1e-8))  # invert since lower distance = more similar
+        combined[d] = bm25_weight * bm25_norm + faiss_weight * faiss_norm
+    return combined
+
+if njit is not None:
+    # no fastmath, the scores must match the numpy expression they replace
+    _combined_scores_jit = njit(cache=True)(_combined_scores_jit)
+
+def top_k_descending(scores, k):
+    """Indices of the k highest scores, best first. Only the k selected scores are sorted."""
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    if k >= scores.shape[0]:
+        return np.argsort(scores)[::-1]
+    top = np.argpartition(scores, scores.shape[0] - k)[-k:]
+    return top[np.argsort(scores[top])[::-1]]
+
+
+class JitBM25Okapi(BM25Okapi):
+    """BM25Okapi that keeps flat CSR arrays of the corpus so queries are scored by a numba kernel."""
+
+    @classmethod
+    def from_bm25(cls, bm25_index: BM25Okapi) -> "JitBM25Okapi":
+        """Upgrades an index unpickled from an older run."""
+        if isinstance(bm25_index, cls) and hasattr(bm25_index, "indptr"):
+            return bm25_index
+        jit_index = cls.__new__(cls)
+        jit_index.__dict__.update(bm25_index.__dict__)
+        return jit_index.activate_numba_scorer()
+
+    def activate_numba_scorer(self) -> "JitBM25Okapi":
+        """Precomputes idf and length normalization arrays and switches get_scores to the kernel."""
+        self.term_ids = {term: i for i, term in enumerate(self.idf)}
+        self.idf_array = np.fromiter(self.idf.values(), dtype=np.float64, count=len(self.idf))
+
+        # one row per document (CSR), precompute_term_scores regroups the entries term by term for the kernel
+        indptr = np.zeros(self.corpus_size + 1, dtype=np.int64)
+        doc_term_ids, doc_term_freqs = [], []
+        for d, frequencies in enumerate(self.doc_freqs):
+            doc_term_ids.extend(self.term_ids[term] for term in frequencies)
+            doc_term_freqs.extend(frequencies.values())
+            indptr[d + 1] = len(doc_term_ids)
+        self.indptr = indptr
+        self.doc_term_ids = np.array(doc_term_ids, dtype=np.int64)
+        self.doc_term_freqs = np.array(doc_term_freqs, dtype=np.float64)
+
+        # k1 * (1 - b + b * dl / avgdl), the query independent part of the denominator
+        self.length_norm = self.k1 * (1 - self.b + self.b * np.asarray(self.doc_len, dtype=np.float64) / self.avgdl)
+        self.precompute_term_scores()
+        self.use_numba = njit is not None
+        return self
+
+    def precompute_term_scores(self):
+        """BM25 score of every (document, term) entry, stored term by term (CSC): a query sums the postings of its terms."""
+        tf = np.asarray(self.doc_term_freqs, dtype=np.float64)
+        entry_docs = np.repeat(np.arange(self.corpus_size), np.diff(self.indptr))
+        doc_term_scores = self.idf_array[self.doc_term_ids] * (tf * (self.k1 + 1) / (tf + self.length_norm[entry_docs]))
+        # stable, so the documents of a term stay in increasing order
+        order = np.argsort(self.doc_term_ids, kind="stable")
+        self.term_indptr = np.zeros(len(self.idf_array) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.doc_term_ids, minlength=len(self.idf_array)), out=self.term_indptr[1:])
+        self.posting_docs = entry_docs[order].astype(np.int32)
+        self.posting_scores = doc_term_scores[order]
+
+    def save_arrays(self, index_dir: str):
+        """Writes the CSR arrays as .npy files so later runs can memory-map them instead of unpickling."""
+        os.makedirs(index_dir, exist_ok=True)
+        np.save(os.path.join(index_dir, "terms.npy"), np.array(list(self.term_ids)))
+        np.save(os.path.join(index_dir, "idf.npy"), self.idf_array)
+        np.save(os.path.join(index_dir, "indptr.npy"), self.indptr)
+        np.save(os.path.join(index_dir, "token_ids.npy"), self.doc_term_ids.astype(np.int32))
+        np.save(os.path.join(index_dir, "tf_values.npy"), self.doc_term_freqs.astype(np.float32))
+        np.save(os.path.join(index_dir, "doc_len.npy"), np.asarray(self.doc_len, dtype=np.int32))
+        np.save(os.path.join(index_dir, "term_indptr.npy"), self.term_indptr)
+        np.save(os.path.join(index_dir, "posting_docs.npy"), self.posting_docs)
+        np.save(os.path.join(index_dir, "posting_scores.npy"), self.posting_scores)
+        with open(os.path.join(index_dir, "params.json"), "w", encoding="utf-8") as f:
+            json.dump({"k1": self.k1, "b": self.b, "epsilon": self.epsilon, "avgdl": self.avgdl}, f)
+
+    @classmethod
+    def load_arrays(cls, index_dir: str) -> "JitBM25Okapi":
+        """Memory-maps an index written by save_arrays. It only supports get_scores, there is no doc_freqs."""
+        with open(os.path.join(index_dir, "params.json"), encoding="utf-8") as f:
+            params = json.load(f)
+        bm25_index = cls.__new__(cls)
+        bm25_index.k1, bm25_index.b, bm25_index.epsilon, bm25_index.avgdl = params["k1"], params["b"], params["epsilon"], params["avgdl"]
+        load = lambda name: np.load(os.path.join(index_dir, f"{name}.npy"), mmap_mode="r")
+        terms = load("terms")
+        bm25_index.term_ids = {term: i for i, term in enumerate(terms.tolist())}
+        bm25_index.idf_array = load("idf")
+        bm25_index.indptr = load("indptr")
+        bm25_index.doc_term_ids = load("token_ids")
+        bm25_index.doc_term_freqs = load("tf_values")
+        bm25_index.doc_len = load("doc_len")
+        bm25_index.corpus_size = len(bm25_index.doc_len)
+        bm25_index.length_norm = bm25_index.k1 * (1 - bm25_index.b + bm25_index.b * bm25_index.doc_len / bm25_index.avgdl)
+        if os.path.exists(os.path.join(index_dir, "posting_scores.npy")):
+            bm25_index.term_indptr = load("term_indptr")
+            bm25_index.posting_docs = load("posting_docs")
+            bm25_index.posting_scores = load("posting_scores")
+        else:
+            # stored before the postings were saved with the index
+            bm25_index.precompute_term_scores()
+        bm25_index.use_numba = True  # without doc_freqs the kernel is the only scorer, jitted or not
+        return bm25_index
+
+    def get_scores(self, query):
+        if not getattr(self, "use_numba", False):
+            return super().get_scores(query)
+        return self.get_scores_many([query])[0]
+
+    def get_scores_many(self, queries):
+        """BM25 scores of every query against every document, shape (len(queries), corpus_size), in one kernel call."""
+        if not getattr(self, "use_numba", False):
+            return np.array([self.get_scores(query) for query in queries], dtype=np.float64).reshape(len(queries), -1)
+        query_terms = [[self.term_ids[q] for q in query if q in self.term_ids] for query in queries]
+        query_indptr = np.zeros(len(queries) + 1, dtype=np.int64)
+        query_indptr[1:] = np.cumsum([len(terms) for terms in query_terms])
+        query_ids = np.array([term_id for terms in query_terms for term_id in terms], dtype=np.int64)
+        return _bm25_postings_scores_jit(query_indptr, query_ids, self.term_indptr, self.posting_docs, self.posting_scores,
+                                         self.corpus_size)
+
+
+# faiss-gpu cannot return more neighbours than this per query
+GPU_MAX_K = 2048
+
+def index_to_gpus(cpu_index):
+    """Returns a copy of the FAISS index replicated on every visible GPU, or None when there are none."""
+    num_gpus = faiss.get_num_gpus()
+    if num_gpus == 0:
+        return None
+    print(f"Copying FAISS index to {num_gpus} GPU(s)...")
+    cloner_options = faiss.GpuMultipleClonerOptions()
+    cloner_options.useFloat16 = True  # fp16 vectors and GEMMs, half the memory traffic of fp32
+    try:
+        return faiss.index_cpu_to_all_gpus(cpu_index, cloner_options)
+    except RuntimeError as e:
+        print(f"FAISS index stays on CPU: {e}")
+        return None
+
+# memory-map the stored vectors (flat codes and IVF lists) instead of reading them into each process
+FAISS_MMAP_FLAGS = faiss.IO_FLAG_MMAP | getattr(faiss, "IO_FLAG_MMAP_IFC", 0) | faiss.IO_FLAG_READ_ONLY
+
+# indexes already returned by index_source_code in this process: FAISS index folder -> (source fingerprint, indexes)
+_INDEX_CACHE = {}
+
+# corpora smaller than this are scanned faster by the exact flat index than by IVF-PQ
+PQ_MIN_VECTORS = 50000
+# nearest neighbours the compressed index returns per query (re-ranked exactly with the raw vectors),
+# the other documents rank as the least similar on the FAISS side
+FAISS_CANDIDATES = 2048
+# documents embedded per step while building the FAISS index, bounds the embeddings held as Python lists
+FAISS_BUILD_CHUNK = 4096
+
+def compress_faiss_index(flat_index):
+    """Re-encodes a flat FAISS index as IVF-PQ with 4-bit FastScan codes and an exact re-rank of the candidates.
+    The IVF centroids are searched through an HNSW graph instead of a flat scan over all nlist of them."""
+    n, d = flat_index.ntotal, flat_index.d
+    if n < PQ_MIN_VECTORS or d % 16:
+        return flat_index
+    nlist = int(4 * np.sqrt(n))
+    # one 4-bit code per 8 dimensions, same L2 metric as the flat index
+    factory = f"IVF{nlist}_HNSW32,PQ{d // 8}x4fs"
+    ivfpq_index = faiss.index_factory(d, factory, flat_index.metric_type)
+    compressed_index = faiss.IndexRefineFlat(ivfpq_index)
+    compressed_index.k_factor = 4  # re-rank 4x the requested neighbours with the raw vectors
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # the raw vectors are copied chunk by chunk to a disk-backed array, so training and adding
+        # page them in instead of holding a second in-memory copy next to the flat index
+        vectors = np.memmap(os.path.join(tmp_dir, "vectors.f32"), dtype=np.float32, mode="w+", shape=(n, d))
+        for start in range(0, n, FAISS_BUILD_CHUNK):
+            vectors[start:start + FAISS_BUILD_CHUNK] = flat_index.reconstruct_n(start, min(FAISS_BUILD_CHUNK, n - start))
+        print(f"Training {factory} on {n} vectors...")
+        compressed_index.train(vectors)
+        for start in range(0, n, FAISS_BUILD_CHUNK):
+            compressed_index.add(np.ascontiguousarray(vectors[start:start + FAISS_BUILD_CHUNK]))
+        del vectors
+    ivf_index = faiss.extract_index_ivf(ivfpq_index)
+    ivf_index.nprobe = max(1, nlist // 8)
+    # the graph has to explore at least nprobe centroids to return them
+    faiss.downcast_index(ivf_index.quantizer).hnsw.efSearch = 2 * ivf_index.nprobe
+    return compressed_index
+
+
+# one embedding model per name, reused when several projects are indexed in the same process
+@functools.lru_cache(maxsize=None)
+def load_hf_embedder(model_name: str) -> HuggingFaceEmbeddings:
+    # fp16 weights when the embedding model runs on a GPU, ONNX Runtime on CPU when installed
+    model_kwargs = {"model_kwargs": {"torch_dtype": torch.float16}} if torch.cuda.is_available() else embedding_backend_kwargs()
+    # a localization batch embeds all its queries in one embed_documents call, encoded 64 at a time
+    return HuggingFaceEmbeddings(model_name=model_name, model_kwargs=model_kwargs, encode_kwargs={"batch_size": 64})
+
+# List of extensions you want to include
+SOURCE_EXTENSIONS = ["*.kt","*.csproj","*.py", "*.cpp", "*.c", "*.h", "*.hpp", "*.java", "*.js", "*.ts", "*.cs", "*.go", "*.php","*.vue"]
+
+def source_fingerprint(source_code_dir: str, model_tag: str) -> str:
+    """Hash of the path, size and mtime of every indexed source file and of the embedding model and backend,
+    it changes whenever the stored indexes no longer match the source code or the embeddings."""
+    suffixes = tuple(ext[1:] for ext in SOURCE_EXTENSIONS)
+    entries = []
+    for root, _, files in os.walk(source_code_dir):
+        for name in files:
+            if name.endswith(suffixes):
+                stat = os.stat(os.path.join(root, name))
+                entries.append(f"{os.path.relpath(os.path.join(root, name), source_code_dir)}\0{stat.st_size}\0{stat.st_mtime_ns}")
+    entries.sort()
+    return hashlib.blake2b("\n".join([model_tag, *entries]).encode("utf-8"), digest_size=16).hexdigest()
+
+def index_source_code(source_code_dir: str, project_name: str = None, bm25_faiss_dir: str = None, rebuild: bool = False) -> str:
+    # Define the BM25 and FAISS index paths
+    if project_name and bm25_faiss_dir:
+        os.makedirs(bm25_faiss_dir, exist_ok=True)
+        index_path = os.path.join(bm25_faiss_dir, f"bm25_index_{project_name}.pkl")
+        bm25_index_dir = os.path.join(bm25_faiss_dir, f"bm25_index_dir_{project_name}")
+        faiss_index_dir = os.path.join(bm25_faiss_dir, f"faiss_index_dir_{project_name}")
+        fingerprint_path = os.path.join(bm25_faiss_dir, f"source_fingerprint_{project_name}.txt")
+    else:
+        # Fallback to old naming for compatibility
+        index_path = "./bm25_index_project3.pkl"
+        bm25_index_dir = "./bm25_index_dir_project3"
+        faiss_index_dir = "./faiss_index_dir_project3"
+        fingerprint_path = "./source_fingerprint_project3.txt"
+
+    # Embedding model of the FAISS index
+    model_name = "BAAI/bge-small-en-v1.5"
+    #model_name = "microsoft/codebert-base"
+    hf_embedder = load_hf_embedder(model_name)
+    # searches run from a single localize worker, one batch at a time, so FAISS can use every core
+    faiss.omp_set_num_threads(os.cpu_count() or 1)
+
+    # Stored indexes built from other source files or embeddings (or rebuild requested) are removed and built again.
+    # Indexes stored without a fingerprint predate it and are kept
+    # a FAISS index built with another backend (fp16, ONNX, PyTorch) holds slightly different embeddings
+    fingerprint = source_fingerprint(source_code_dir, f"{model_name}/{embedding_backend_tag()}")
+    # the same project indexed again in this process (e.g. listed twice) reuses the indexes it already loaded
+    cached = _INDEX_CACHE.get(faiss_index_dir)
+    if not rebuild and cached is not None and cached[0] == fingerprint:
+        print("BM25 and FAISS indexes already loaded in this process. Reusing them...")
+        return cached[1]
+    stored_fingerprint = None
+    if os.path.exists(fingerprint_path):
+        with open(fingerprint_path, encoding="utf-8") as f:
+            stored_fingerprint = f.read().strip()
+    if rebuild or stored_fingerprint not in (None, fingerprint):
+        print("Source code or embedding backend changed, or rebuild requested. Removing the stored BM25 and FAISS indexes...")
+        for path in (bm25_index_dir, faiss_index_dir):
+            shutil.rmtree(path, ignore_errors=True)
+        if os.path.exists(index_path):
+            os.remove(index_path)
+    def save_fingerprint():
+        with open(fingerprint_path, "w", encoding="utf-8") as f:
+            f.write(fingerprint)
+
+    # Both indexes exist: the processed documents are the FAISS docstore, in index order,
+    # so the source code does not need to be loaded and preprocessed again
+    if os.path.exists(os.path.join(bm25_index_dir, "params.json")) and os.path.exists(faiss_index_dir) and os.listdir(faiss_index_dir):
+        print("BM25 and FAISS indexes exist. Loading them without re-reading the source code...")
+        bm25_index = JitBM25Okapi.load_arrays(bm25_index_dir)
+        faiss_index = FAISS.load_local(faiss_index_dir, hf_embedder, allow_dangerous_deserialization=True, io_flags=FAISS_MMAP_FLAGS)
+        processed_documents = [faiss_index.docstore.search(faiss_index.index_to_docstore_id[row]) for row in range(len(faiss_index.index_to_docstore_id))]
+        faiss_index.gpu_index = index_to_gpus(faiss_index.index)
+        if stored_fingerprint is None:
+            save_fingerprint()
+        _INDEX_CACHE[faiss_index_dir] = (fingerprint, (bm25_index, faiss_index, processed_documents))
+        return bm25_index, faiss_index, processed_documents
+
     documents = []  # from DirectoryLoader, etc.
     # Load source code files (recursively from a folder)
     source_code_dir = source_code_dir  # Folder with 1000 source code files
     print("Indexing source code from: ", source_code_dir)
-    # List of extensions you want to include
-    source_extensions = ["*.kt","*.csproj","*.py", "*.cpp", "*.c", "*.h", "*.hpp", "*.java", "*.js", "*.ts", "*.cs", "*.go", "*.php","*.vue"]
     # Create loaders for each extension
     loaders = [
         DirectoryLoader(
@@ -252,7 +653,7 @@ def index_source_code(source_code_dir: str, project_name: str = None, bm25_faiss
             loader_cls=TextLoader,
             recursive=True
         )
-        for ext in source_extensions
+        for ext in SOURCE_EXTENSIONS
     ]
 
     # Combine all loaded documents
@@ -274,24 +675,16 @@ def index_source_code(source_code_dir: str, project_name: str = None, bm25_faiss
 
     # Save only the tokenized_corpus
     # Check if index already exists
-    if project_name and bm25_faiss_dir:
-        os.makedirs(bm25_faiss_dir, exist_ok=True)
-        index_path = os.path.join(bm25_faiss_dir, f"bm25_index_{project_name}.pkl")
-    else:
-        # Fallback to old naming for compatibility
-        index_path = "./bm25_index_project3.pkl"
-        
-    if os.path.exists(index_path):
-        print("Index exists. Loading from file...")
+    if os.path.exists(os.path.join(bm25_index_dir, "params.json")):
+        print("Index exists. Memory-mapping it...")
+    elif os.path.exists(index_path):
+        print("Index exists as a pickle. Converting it to arrays...")
         with open(index_path, "rb") as f:
-            bm25_index = pickle.load(f)
+            JitBM25Okapi.from_bm25(pickle.load(f)).save_arrays(bm25_index_dir)
     else:
         print("Index not found. Building new BM25 index...")
-        bm25_index = BM25Okapi(tokenized_corpus)
-    
         # Save the index
-        with open(index_path, "wb") as f:
-            pickle.dump(bm25_index, f)
+        JitBM25Okapi(tokenized_corpus).activate_numba_scorer().save_arrays(bm25_index_dir)
 
 
     # -----------------------
@@ -307,41 +700,48 @@ def index_source_code(source_code_dir: str, project_name: str = None, bm25_faiss
         )
         processed_documents.append(processed_doc)
     print("Processed documents: ", processed_documents)
-    # Embed and build FAISS index
-    model_name = "BAAI/bge-small-en-v1.5"
-    #model_name = "microsoft/codebert-base"
-    hf_embedder = HuggingFaceEmbeddings(model_name=model_name)
-
-    # Define the FAISS index directory path
-    if project_name and bm25_faiss_dir:
-        faiss_index_dir = os.path.join(bm25_faiss_dir, f"faiss_index_dir_{project_name}")
-    else:
-        # Fallback to old naming for compatibility
-        faiss_index_dir = "./faiss_index_dir_project3"
 
-    # Check if index already exists
+    # Embed and build FAISS index, check if it already exists
     if os.path.exists(faiss_index_dir) and os.listdir(faiss_index_dir):
         print("FAISS index already exists. Loading it...")
-        faiss_index = FAISS.load_local(faiss_index_dir, hf_embedder, allow_dangerous_deserialization=True)
+        faiss_index = FAISS.load_local(faiss_index_dir, hf_embedder, allow_dangerous_deserialization=True, io_flags=FAISS_MMAP_FLAGS)
     else:
         print("FAISS index not found. Creating a new one...")
-        faiss_index = FAISS.from_documents(processed_documents, hf_embedder)
+        # embedded chunk by chunk, the embeddings of one chunk are freed once they are in the index
+        faiss_index = FAISS.from_documents(processed_documents[:FAISS_BUILD_CHUNK], hf_embedder)
+        for start in range(FAISS_BUILD_CHUNK, len(processed_documents), FAISS_BUILD_CHUNK):
+            faiss_index.add_documents(processed_documents[start:start + FAISS_BUILD_CHUNK])
+        faiss_index.index = compress_faiss_index(faiss_index.index)
         # Save the new index
         faiss_index.save_local(faiss_index_dir)
 
     print("BM25 and FAISS indexes are loaded.")
     # Load the indexes
+    bm25_index = JitBM25Okapi.load_arrays(bm25_index_dir)
     if project_name and bm25_faiss_dir:
-        bm25_index = pickle.load(open(os.path.join(bm25_faiss_dir, f"bm25_index_{project_name}.pkl"), "rb"))
-        faiss_index = FAISS.load_local(os.path.join(bm25_faiss_dir, f"faiss_index_dir_{project_name}"), hf_embedder, allow_dangerous_deserialization=True)
+        faiss_index = FAISS.load_local(os.path.join(bm25_faiss_dir, f"faiss_index_dir_{project_name}"), hf_embedder, allow_dangerous_deserialization=True, io_flags=FAISS_MMAP_FLAGS)
     else:
-        bm25_index = pickle.load(open("bm25_index_project3.pkl", "rb"))
-        faiss_index = FAISS.load_local(faiss_index_dir, hf_embedder, allow_dangerous_deserialization=True)
+        faiss_index = FAISS.load_local(faiss_index_dir, hf_embedder, allow_dangerous_deserialization=True, io_flags=FAISS_MMAP_FLAGS)
+    faiss_index.gpu_index = index_to_gpus(faiss_index.index)
+    save_fingerprint()
+    _INDEX_CACHE[faiss_index_dir] = (fingerprint, (bm25_index, faiss_index, processed_documents))
     #print("BM25 and FAISS indexes are loaded.")
     #print("Processed documents: ", processed_documents)
     return bm25_index, faiss_index, processed_documents
 
 
+def faiss_document_rows(faiss_index: FAISS, processed_documents: list[Document]) -> np.ndarray:
+    '''Maps every processed document to the FAISS row holding the same content (-1 if it has none).
+    Computed once per index and document list, every localization batch reuses it'''
+    cached = getattr(faiss_index, "document_rows", None)
+    if cached is not None and cached[0] is processed_documents:
+        return cached[1]
+    content_rows = {faiss_index.docstore.search(docstore_id).page_content: row
+                    for row, docstore_id in faiss_index.index_to_docstore_id.items()}
+    document_rows = np.array([content_rows.get(doc.page_content, -1) for doc in processed_documents], dtype=np.int64)
+    faiss_index.document_rows = (processed_documents, document_rows)
+    return document_rows
+
 def bug_localization_BM25_and_FAISS(bug_id: str, bug_report_query: str, top_n: int, bm25_index: BM25Okapi, faiss_index: FAISS, processed_documents: list[Document], bm25_weight: float, faiss_weight: float) -> str:
     """Localizes the bug report using BM25 and FAISS and returns it as a string.
 
@@ -358,39 +758,77 @@ def bug_localization_BM25_and_FAISS(bug_id: str, bug_report_query: str, top_n: i
     Returns:
         str: The top n documents and their scores.
     """
-    print("Bug localization started...")
-    #print("Bug ID: ", bug_id)
-    #print("Bug report query: ", bug_report_query)
-    #print("Top n: ", top_n)
+    return bug_localization_BM25_and_FAISS_batch([bug_id], [bug_report_query], top_n, bm25_index, faiss_index,
+                                                  processed_documents, bm25_weight, faiss_weight)[0]
+
+def bug_localization_BM25_and_FAISS_batch(bug_ids: list[str], bug_report_queries: list[str], top_n: int, bm25_index: BM25Okapi, faiss_index: FAISS, processed_documents: list[Document], bm25_weight: float, faiss_weight: float) -> list[str]:
+    """Localizes several bug report queries at once, embedding them and searching FAISS in one batch.
+
+    Args:
+        bug_ids (list[str]): The ID of the bug report of each query.
+        bug_report_queries (list[str]): The queries to localize.
+        top_n (int): The number of top documents to retrieve.
+        bm25_index (BM25Okapi): The BM25 index.
+        faiss_index (FAISS): The FAISS index.
+        processed_documents (list[Document]): The processed documents.
+        bm25_weight (float): The weight of the BM25 index.
+        faiss_weight (float): The weight of the FAISS index.
+
+    Returns:
+        list[str]: The top n documents and their scores, one string per query.
+    """
+    print(f"Bug localization started for {len(bug_report_queries)} queries...")
     print("BM25 index: ", bm25_index.corpus_size)
     print("FAISS index: ", faiss_index)
-    # --- BM25 ---
-    bm25_scores = bm25_index.get_scores(bug_report_query)
-    
-    # --- FAISS ---
-    faiss_docs_and_scores = faiss_index.similarity_search_with_score(bug_report_query, k=len(processed_documents))
-    faiss_scores_dict = {doc.page_content: score for doc, score in faiss_docs_and_scores}
-    
-    # --- Normalize scores ---
-    bm25_scores_np = np.array(bm25_scores)
-    bm25_norm = (bm25_scores_np - bm25_scores_np.min()) / (np.ptp(bm25_scores_np) + 1e-8)
 
-    faiss_raw_scores = np.array([faiss_scores_dict.get(doc.page_content, 1e6) for doc in processed_documents])
-    faiss_norm = 1 - ((faiss_raw_scores - faiss_raw_scores.min()) / (np.ptp(faiss_raw_scores) + 1e-8))  # invert since lower distance = more similar
+    # --- FAISS: a single (nq, d) search for all queries ---
+    query_vectors = np.array(faiss_index.embedding_function.embed_documents(bug_report_queries), dtype=np.float32)
+    if faiss_index._normalize_L2:
+        faiss.normalize_L2(query_vectors)
+    k = len(processed_documents)
+    if isinstance(faiss_index.index, faiss.IndexRefine):
+        # the compressed index is approximate anyway: only a bounded candidate set is generated and re-ranked,
+        # instead of refining every document of the corpus
+        k = min(k, FAISS_CANDIDATES)
+    search_index = faiss_index.index
+    gpu_index = getattr(faiss_index, "gpu_index", None)
+    if gpu_index is not None and k <= GPU_MAX_K:
+        search_index = gpu_index
+    distances, rows = search_index.search(query_vectors, k)
+
+    document_rows = faiss_document_rows(faiss_index, processed_documents)
+
+    # --- BM25: all queries scored in one pass over the corpus ---
+    if isinstance(bm25_index, JitBM25Okapi):
+        all_bm25_scores = bm25_index.get_scores_many(bug_report_queries)
+    else:
+        all_bm25_scores = [bm25_index.get_scores(query) for query in bug_report_queries]
+
+    results = []
+    for bm25_scores, query_distances, query_rows in zip(all_bm25_scores, distances, rows):
 
-    # --- Combine ---
-    combined_score = bm25_weight * bm25_norm + faiss_weight * faiss_norm
-    top_indices = np.argsort(combined_score)[::-1][:top_n]
+        # documents not returned by FAISS (IVF probes, stale index) rank as the least similar,
+        # the extra last slot catches documents without a FAISS row
+        found = query_rows >= 0
+        missing_distance = query_distances[found].max() if found.any() else 1e6
+        row_distances = np.full(faiss_index.index.ntotal + 1, missing_distance, dtype=np.float64)
+        row_distances[query_rows[found]] = query_distances[found]
+
+        # --- Normalize and combine in one kernel ---
+        combined_score = _combined_scores_jit(np.asarray(bm25_scores, dtype=np.float64), row_distances, document_rows,
+                                              float(bm25_weight), float(faiss_weight))
+        top_indices = top_k_descending(combined_score, top_n)
+
+        top_docs = [(processed_documents[i], combined_score[i]) for i in top_indices]
+
+        string_top_docs = ""
+        for i, (doc, score) in enumerate(top_docs):
+            filename = doc.metadata.get('filename', 'unknown')
+            short_filename = get_short_filename(filename)
+            string_top_docs += f"{i+1},{short_filename},{score:.3f}"+"\n"
+        results.append(string_top_docs)
+    return results
 
-    top_docs = [(processed_documents[i], combined_score[i]) for i in top_indices]
-    
-    string_top_docs = ""
-    for i, (doc, score) in enumerate(top_docs):
-        filename = doc.metadata.get('filename', 'unknown')
-        short_filename = get_short_filename(filename)
-        string_top_docs += f"{i+1},{short_filename},{score:.3f}"+"\n"
-    return string_top_docs
-     
 def get_short_filename(filename_long: str) -> str:
     full_path = Path(filename_long)
     parts = full_path.parts